@@ -7,18 +7,201 @@ VERSIE 3.0 - BACHELOR SUITE (Jaar 1, 2 & 3) + Alle Bug Fixes
 """
 
 import streamlit as st
+import httpx
 import os
+import io
 import base64
+import bisect
+import hashlib
 import json
+import logging
+import math
 import re
 import random
+import sqlite3
+import threading
+import uuid
+import time
+import zlib
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from dotenv import load_dotenv
+import numpy as np
+import openai
 from openai import OpenAI
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from PyPDF2 import PdfReader
+from pdf_worker import extract_page_range
 
 # Laad environment variabelen
 load_dotenv()
 
+# Logging van scheduler- en batchbeslissingen; niveau via LOG_LEVEL (DEBUG, INFO, WARNING, ...).
+# Het script draait bij elke rerun opnieuw, dus de handler wordt maar één keer toegevoegd.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logger = logging.getLogger("studietrainer")
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+if not logger.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(log_handler)
+    logger.propagate = False
+
+
+# ============================================================================
+# ⚡ PERFORMANCE CONFIGURATIE
+# ============================================================================
+
+# Prefix van foutmeldingen die get_ai_response teruggeeft in plaats van een antwoord
+AI_ERROR_PREFIX = "❌ Fout bij AI aanroep"
+
+# Tentamenvragen worden in batches gegenereerd; maximaal EXAM_MAX_CONCURRENCY batches tegelijk
+# worden bij de AI aangevraagd. De prefetcher zet batches van EXAM_BATCH_SIZE vragen klaar.
+EXAM_BATCH_SIZE = 5
+EXAM_MAX_CONCURRENCY = max(1, int(os.getenv("EXAM_MAX_CONCURRENCY", "4")))
+# 📐 Batchplanner: batchgrootte (max EXAM_MAX_BATCH_SIZE) en max_tokens per batch volgen uit de
+# gemeten output tokens per vraag per (studie, vraagtype); zonder metingen EXAM_TOKENS_PER_QUESTION.
+# max_tokens krijgt een veiligheidsmarge (start BATCH_TOKEN_MARGIN) die groeit na afgekapte batches.
+EXAM_MAX_BATCH_SIZE = max(1, int(os.getenv("EXAM_MAX_BATCH_SIZE", "10")))
+# Kleinere batches geven meer (bijna) dubbele vragen: batches zien elkaars vragen niet
+EXAM_MIN_BATCH_SIZE = max(1, int(os.getenv("EXAM_MIN_BATCH_SIZE", "3")))
+# Plannen met minder aanroepen winnen zolang ze binnen deze marge van de snelste verwachte duur blijven
+BATCH_PLAN_TOLERANCE = 0.1
+EXAM_TOKENS_PER_QUESTION = int(os.getenv("EXAM_TOKENS_PER_QUESTION", "250"))
+BATCH_TOKEN_MARGIN = 1.3
+BATCH_TOKEN_MARGIN_MAX = 2.0
+BATCH_ENVELOPE_TOKENS = 50
+# Ontbrekende of ongeldige vragen worden gericht bijgevraagd, maximaal EXAM_TOPUP_ROUNDS keer
+EXAM_TOPUP_ROUNDS = max(0, int(os.getenv("EXAM_TOPUP_ROUNDS", "2")))
+
+# PDF extractie cache: aantal PDF's in het geheugen en maximale grootte op schijf
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(".cache", "pdf_text"))
+PDF_CACHE_MEMORY_ITEMS = max(1, int(os.getenv("PDF_CACHE_MEMORY_ITEMS", "32")))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_MB", "500")) * 1024 * 1024
+
+# Parallelle PDF extractie: vanaf dit aantal pagina's wordt een process pool gebruikt
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_EXTRACT_WORKERS = max(1, int(os.getenv("PDF_EXTRACT_WORKERS", str(min(os.cpu_count() or 1, 8)))))
+
+# Retrieval: bronnen groter dan RETRIEVAL_MIN_SOURCE_CHARS worden in chunks opgeknipt
+# en per AI aanroep wordt alleen de top-k van relevante chunks meegestuurd
+RETRIEVAL_MIN_SOURCE_CHARS = int(os.getenv("RETRIEVAL_MIN_SOURCE_CHARS", "12000"))
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1200"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+
+# Gespreksgeschiedenis in oefenmodus: de laatste N beurten gaan letterlijk mee,
+# oudere beurten worden per PRACTICE_SUMMARY_BATCH_TURNS samengevat
+PRACTICE_HISTORY_KEEP_TURNS = int(os.getenv("PRACTICE_HISTORY_KEEP_TURNS", "4"))
+PRACTICE_SUMMARY_BATCH_TURNS = max(1, int(os.getenv("PRACTICE_SUMMARY_BATCH_TURNS", "4")))
+
+# Speculatief oefenen: bereid de volgende vraag al voor terwijl de student typt (standaardwaarde toggle)
+PRACTICE_SPECULATIVE_DEFAULT = os.getenv("PRACTICE_SPECULATIVE_DEFAULT", "0") == "1"
+
+# Gedeelde thread pool voor achtergrondwerk (samenvattingen e.d.)
+BACKGROUND_WORKERS = max(1, int(os.getenv("BACKGROUND_WORKERS", "16")))
+
+# Gedeelde HTTP connection pool voor de OpenAI client (alle sessies)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+
+# Response cache voor generatie zonder bestand (zelfde vak/boek/vraagtype = zelfde prompt).
+# RESPONSE_CACHE_VARIANTS > 1 activeert de variatie-policy: per prompt worden K varianten
+# verzameld en daarna willekeurig uitgeserveerd.
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_VARIANTS = max(1, int(os.getenv("RESPONSE_CACHE_VARIANTS", "1")))
+
+# Persistente vragenbank (SQLite): hergebruik eerder gegenereerde vragen en flashcards
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK_ENABLED", "1") == "1"
+QUESTION_BANK_PATH = os.getenv("QUESTION_BANK_PATH", os.path.join(".cache", "question_bank.sqlite3"))
+
+# Bijna-duplicaten: MinHash over karakter-shingles van vraag + correct antwoord, met LSH
+# (LSH_BANDS banden van MINHASH_PERMUTATIONS / LSH_BANDS rijen) om kandidaten te vinden.
+# Items met geschatte Jaccard-gelijkenis >= NEAR_DUPLICATE_THRESHOLD gelden als duplicaat.
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+MINHASH_PERMUTATIONS = 64
+MINHASH_SHINGLE_SIZE = 5
+LSH_BANDS = 16
+
+# Achtergrond-prefetch: houd per sessie een kleine voorraad tentamen-batches/flashcard decks
+# klaar voor de huidige selectie; aanvullen tot de doelvoorraad zodra die onder de watermark zakt
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_EXAM_BATCHES = int(os.getenv("PREFETCH_EXAM_BATCHES", "2"))
+PREFETCH_FLASHCARD_DECKS = int(os.getenv("PREFETCH_FLASHCARD_DECKS", "1"))
+PREFETCH_LOW_WATERMARK = int(os.getenv("PREFETCH_LOW_WATERMARK", "1"))
+
+# Globale LLM scheduler: quota per minuut (requests en tokens), maximaal aantal
+# gelijktijdige aanroepen en retries met jittered exponential backoff op 429/5xx
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "500"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "300000"))
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv("LLM_MAX_CONCURRENCY", "32")))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30.0"))
+
+# Deadlines (seconden) per modus: daarna geeft een AI aanroep een foutmelding in plaats van te blijven hangen
+LLM_DEADLINES = {
+    "practice": float(os.getenv("LLM_DEADLINE_PRACTICE", "45")),
+    "exam": float(os.getenv("LLM_DEADLINE_EXAM", "90")),
+    "flashcards": float(os.getenv("LLM_DEADLINE_FLASHCARDS", "90")),
+    "summary": float(os.getenv("LLM_DEADLINE_SUMMARY", "60"))
+}
+
+# Hedging: loopt een aanroep langer dan de p95 van zijn modus, dan gaat er een duplicaat uit
+# en wint het eerste antwoord. HEDGE_MAX_SHARE begrenst het aandeel extra requests.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_MAX_SHARE = float(os.getenv("HEDGE_MAX_SHARE", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = max(1, int(os.getenv("LATENCY_WINDOW", "200")))
+
+# Hoe vaak (seconden) wachtende code controleert of de generatie is afgebroken
+GENERATION_POLL_SECONDS = float(os.getenv("GENERATION_POLL_SECONDS", "0.25"))
+
+# Generatie-jobs: tentamens en flashcards worden op de achtergrond gegenereerd; een
+# fragment ververst elke JOB_POLL_SECONDS de voortgang. Afgeronde jobs worden na
+# JOB_RETENTION_SECONDS opgeruimd.
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "600"))
+# Eigen thread pool voor generatie-jobs, los van het achtergrondwerk (prefetch, samenvattingen)
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "8")))
+
+# Modelroutering: per modus een lijst profielen (model, max_tokens, temperature). Het eerste
+# profiel waarvan "max_input_tokens" (optioneel) de geschatte promptgrootte dekt, wordt gebruikt.
+# "vision" geldt voor aanroepen met een afbeelding. Per deployment te overschrijven met
+# MODEL_ROUTES (JSON, per modus), bv.
+# {"flashcards": [{"max_input_tokens": 4000, "model": "gpt-4o-mini", "max_tokens": 2000, "temperature": 0.7},
+#                 {"model": "gpt-4o", "max_tokens": 2000, "temperature": 0.7}]}
+DEFAULT_MODEL_ROUTES = {
+    "practice": [{"model": "gpt-4o", "max_tokens": 3000, "temperature": 0.7}],
+    "exam": [{"model": "gpt-4o", "max_tokens": 3000, "temperature": 0.7}],
+    "flashcards": [{"model": "gpt-4o", "max_tokens": 2000, "temperature": 0.7}],
+    "summary": [{"model": "gpt-4o", "max_tokens": 600, "temperature": 0.3}],
+    "vision": [{"model": "gpt-4o", "max_tokens": 3000, "temperature": 0.7}]
+}
+try:
+    MODEL_ROUTES = {**DEFAULT_MODEL_ROUTES, **json.loads(os.getenv("MODEL_ROUTES", "{}"))}
+except (ValueError, TypeError):
+    logger.warning("MODEL_ROUTES is geen geldig JSON object; de standaard modelroutes worden gebruikt.")
+    MODEL_ROUTES = dict(DEFAULT_MODEL_ROUTES)
+
+# Tentamen- en flashcard-aanroepen vragen structured outputs met een strikt JSON schema;
+# uitzetten (STRUCTURED_OUTPUTS=0) valt terug op json_object voor modellen/proxies zonder ondersteuning
+STRUCTURED_OUTPUTS_ENABLED = os.getenv("STRUCTURED_OUTPUTS", "1") == "1"
+
+# Tokengebruik: aantal recente aanroepen (met gecachete prompt tokens) in het prestatie-paneel
+TOKEN_USAGE_RECENT_CALLS = int(os.getenv("TOKEN_USAGE_RECENT_CALLS", "10"))
+
+# Gememoiseerde system prompts (per studie/vak/boek/modus/aantal/vraagtype)
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "1024"))
+
+# Toon het prestatie-paneel in de sidebar (voor beheerders)
+SHOW_PERF_STATS = os.getenv("SHOW_PERF_STATS", "0") == "1"
+
 
 # ============================================================================
 # 📚 STUDY FIELDS CONFIGURATIE - BACHELOR SUITE (3 JAREN)
@@ -581,9 +764,9 @@ STIJL:
 # 🎨 STYLING FUNCTIE
 # ============================================================================
 
-def apply_custom_styling(primary_color: str):
+def build_theme_css(primary_color: str) -> str:
     """
-    Pas dynamische 'Light Academia' styling toe.
+    Bouw de dynamische 'Light Academia' stylesheet (leesbare bronversie).
     Thema: Antiek Perkament & Donker Leder.
     """
     custom_css = f"""
@@ -828,7 +1011,38 @@ def apply_custom_styling(primary_color: str):
         header {{visibility: hidden;}}
     </style>
     """
-    st.markdown(custom_css, unsafe_allow_html=True)
+    return custom_css
+
+
+def minify_css(css: str) -> str:
+    """Verwijder commentaar en overbodige witruimte uit een stylesheet."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+@st.cache_resource
+def get_theme_stylesheets() -> dict:
+    """
+    ⚡ Geminificeerde stylesheets voor alle studiekleuren, één keer per server
+    proces gebouwd (~3 ms) en daarna gedeeld door alle sessies en reruns.
+    """
+    colors = {config["color"] for config in STUDY_FIELDS.values()}
+    return {color: minify_css(build_theme_css(color)) for color in colors}
+
+
+# Eén lookup per script run; get_theme_css indexeert daarna direct in de dict
+THEME_STYLESHEETS = get_theme_stylesheets()
+
+
+def get_theme_css(primary_color: str) -> str:
+    return THEME_STYLESHEETS[primary_color]
+
+
+def apply_custom_styling(primary_color: str):
+    """Pas de (gecachete) 'Light Academia' styling toe in één injectie."""
+    st.markdown(get_theme_css(primary_color), unsafe_allow_html=True)
 
 
 # ============================================================================
@@ -845,10 +1059,18 @@ def reset_study_state():
     st.session_state.selected_subject = STUDY_FIELDS[new_study]["years"][first_year]["sub_subjects"][0]
     st.session_state.selected_book = "Geen specifiek boek / Algemeen"
     
+    # 🛑 Lopende generatie en de prefetch-voorraad horen bij de oude studie
+    cancel_generation()
+    
     # Reset alle session data
     st.session_state.history = []
+    st.session_state.history_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
     st.session_state.context_set = False
     st.session_state.source_text = ""
+    st.session_state.source_hash = None
     st.session_state.image_base64 = None
     st.session_state.file_type = None
     st.session_state.score = 0
@@ -870,10 +1092,18 @@ def reset_year_state():
     st.session_state.selected_subject = STUDY_FIELDS[current_study]["years"][new_year]["sub_subjects"][0]
     st.session_state.selected_book = "Geen specifiek boek / Algemeen"
     
+    # 🛑 Lopende generatie en de prefetch-voorraad horen bij het oude jaar
+    cancel_generation()
+    
     # Reset sessie data
     st.session_state.history = []
+    st.session_state.history_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
     st.session_state.context_set = False
     st.session_state.source_text = ""
+    st.session_state.source_hash = None
     st.session_state.image_base64 = None
     st.session_state.file_type = None
     st.session_state.score = 0
@@ -900,8 +1130,13 @@ def reset_mode_state():
         return
     
     # Normale reset bij handmatige modus-wissel
+    cancel_generation()  # 🛑 Lopende generatie hoort bij de oude modus
     st.session_state.context_set = False
     st.session_state.history = []
+    st.session_state.history_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
     st.session_state.exam_questions = []
     st.session_state.exam_answers = {}
     st.session_state.exam_completed = False
@@ -920,6 +1155,7 @@ def switch_to_practice_mode(vraag: str, user_answer: str, correct_answer: str, u
     """
     # STAP 0: Zet flag om callback te skippen
     st.session_state.skip_mode_reset = True
+    cancel_generation()  # 🛑 Achtergrondwerk voor de tentamenmodus is niet meer nodig
     
     # STAP 1: Forceer de Sidebar Widget
     st.session_state["mode_selector"] = "🟢 Oefenen"
@@ -935,6 +1171,10 @@ def switch_to_practice_mode(vraag: str, user_answer: str, correct_answer: str, u
     
     # STAP 4: Injecteer de Context
     st.session_state.history = []
+    st.session_state.history_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
     
     # Maak een user message met de fout beantwoorde vraag
     user_context_message = f"""Ik had de volgende tentamenvraag fout:
@@ -959,221 +1199,2089 @@ Kun je me dit onderwerp beter uitleggen en me hierover overhoren? Begin met een
 
 
 # ============================================================================
-# 🔧 HELPER FUNCTIES
+# 💾 PDF EXTRACTIE CACHE (CONTENT-ADDRESSED)
 # ============================================================================
 
-def initialize_session_state():
-    """Initialiseer alle session state variabelen."""
-    if "selected_major" not in st.session_state:
-        st.session_state.selected_major = "Geneeskunde 🩺"
-    if "selected_year" not in st.session_state:
-        st.session_state.selected_year = "Jaar 1: De Basis"
-    if "selected_subject" not in st.session_state:
-        first_year = list(STUDY_FIELDS["Geneeskunde 🩺"]["years"].keys())[0]
-        st.session_state.selected_subject = STUDY_FIELDS["Geneeskunde 🩺"]["years"][first_year]["sub_subjects"][0]
-    if "selected_book" not in st.session_state:
-        st.session_state.selected_book = "Geen specifiek boek / Algemeen"
-    if "study_mode" not in st.session_state:
-        st.session_state.study_mode = "🟢 Oefenen"
-    if "exam_num_questions" not in st.session_state:
-        st.session_state.exam_num_questions = 5
-    if "exam_question_type" not in st.session_state:
-        st.session_state.exam_question_type = "Mix"
-    if "skip_mode_reset" not in st.session_state:
-        st.session_state.skip_mode_reset = False
-    if "trigger_ai_response" not in st.session_state:
-        st.session_state.trigger_ai_response = False
-    if "history" not in st.session_state:
-        st.session_state.history = []
-    if "context_set" not in st.session_state:
-        st.session_state.context_set = False
-    if "source_text" not in st.session_state:
-        st.session_state.source_text = ""
-    if "image_base64" not in st.session_state:
-        st.session_state.image_base64 = None
-    if "file_type" not in st.session_state:
-        st.session_state.file_type = None
-    if "score" not in st.session_state:
-        st.session_state.score = 0
-    if "total_questions" not in st.session_state:
-        st.session_state.total_questions = 0
-    if "exam_questions" not in st.session_state:
-        st.session_state.exam_questions = []
-    if "exam_answers" not in st.session_state:
-        st.session_state.exam_answers = {}
-    if "exam_completed" not in st.session_state:
-        st.session_state.exam_completed = False
-    if "flashcards" not in st.session_state:
-        st.session_state.flashcards = []
-    if "current_flashcard_index" not in st.session_state:
-        st.session_state.current_flashcard_index = 0
-    if "show_flashcard_answer" not in st.session_state:
-        st.session_state.show_flashcard_answer = False
-
-
-def get_openai_client():
-    """Haal OpenAI client op of toon error."""
-    api_key = os.getenv("OPENAI_API_KEY")
+class PdfTextCache:
+    """
+    Cache voor geëxtraheerde PDF tekst, geadresseerd op de SHA-256 van de bestandsbytes.
+    Laag 1: LRU in het geheugen. Laag 2: JSON bestanden op schijf, begrensd in
+    totale grootte (oudste/minst recent gebruikte bestanden worden eerst verwijderd).
+    """
     
-    if not api_key:
+    def __init__(self, directory: str, memory_items: int, max_disk_bytes: int):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.json")
+    
+    def get(self, digest: str):
+        """Geef (tekst, aantal pagina's) terug, of None als de PDF nog niet bekend is."""
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return self._memory[digest]
+        
+        path = self._path(digest)
         try:
-            api_key = st.secrets["OPENAI_API_KEY"]
-        except:
-            pass
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(path)  # Markeer als recent gebruikt voor de eviction
+        except (OSError, ValueError):
+            return None
+        
+        entry = (data["text"], data["num_pages"])
+        self._remember(digest, entry)
+        return entry
     
-    if not api_key:
-        st.error("❌ OPENAI_API_KEY niet gevonden. Voeg deze toe aan .env bestand of Streamlit secrets.")
-        st.stop()
+    def put(self, digest: str, text: str, num_pages: int):
+        """Sla het extractieresultaat op in beide lagen."""
+        self._remember(digest, (text, num_pages))
+        
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(digest)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"text": text, "num_pages": num_pages}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(digest))
+            self._evict_disk()
+        except OSError:
+            pass  # De schijflaag is best-effort; het geheugen blijft werken
+    
+    def _remember(self, digest: str, entry: tuple):
+        with self._lock:
+            self._memory[digest] = entry
+            self._memory.move_to_end(digest)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
     
-    return OpenAI(api_key=api_key)
+    def _evict_disk(self):
+        """Verwijder de minst recent gebruikte bestanden tot de cache onder de limiet zit."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total_bytes -= size
+            except OSError:
+                pass
 
 
-def extract_text_from_pdf(pdf_file) -> tuple:
-    """Extraheer tekst uit een PDF bestand."""
-    try:
-        pdf_reader = PdfReader(pdf_file)
-        num_pages = len(pdf_reader.pages)
-        
-        text_parts = []
-        for page in pdf_reader.pages:
-            text_parts.append(page.extract_text())
-        
-        extracted_text = "\n".join(text_parts)
-        return extracted_text, num_pages
-    except Exception as e:
-        st.error(f"❌ Fout bij het lezen van PDF: {str(e)}")
-        return "", 0
+@st.cache_resource
+def get_pdf_text_cache() -> PdfTextCache:
+    """Eén gedeelde PDF cache per server proces (overleeft reruns en sessies)."""
+    return PdfTextCache(PDF_CACHE_DIR, PDF_CACHE_MEMORY_ITEMS, PDF_CACHE_MAX_BYTES)
 
 
-def encode_image(image_file) -> str:
-    """Encode een afbeelding naar base64 string."""
-    return base64.b64encode(image_file.read()).decode('utf-8')
+@st.cache_resource
+def get_pdf_process_pool() -> ProcessPoolExecutor:
+    """
+    Gedeelde process pool voor PDF extractie.
+    'spawn' voorkomt dat de multi-threaded Streamlit server geforkt wordt.
+    """
+    return ProcessPoolExecutor(
+        max_workers=PDF_EXTRACT_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
 
 
-def clean_and_parse_json(response_text: str):
-    """Parse JSON response van AI."""
-    try:
-        text = response_text.strip()
-        if "```" in text:
-            text = re.sub(r'^```(?:json)?\s*', '', text, flags=re.MULTILINE)
-            text = re.sub(r'\s*```$', '', text, flags=re.MULTILINE)
-            text = text.strip()
-        
-        parsed = json.loads(text, strict=False)
+def extract_pages_parallel(pdf_bytes: bytes, num_pages: int) -> list:
+    """
+    ⚡ Verdeel de pagina's in aaneengesloten reeksen over de process pool
+    en plak de tekst in paginavolgorde weer aan elkaar.
+    """
+    chunk_size = -(-num_pages // PDF_EXTRACT_WORKERS)  # Ceil division
+    page_ranges = [(start, min(start + chunk_size, num_pages)) for start in range(0, num_pages, chunk_size)]
+    
+    pool = get_pdf_process_pool()
+    futures = [pool.submit(extract_page_range, pdf_bytes, start, end) for start, end in page_ranges]
+    
+    page_texts = []
+    for future in futures:
+        page_texts.extend(future.result())
+    return page_texts
+
+
+# ============================================================================
+# 🔎 RETRIEVAL INDEX OVER DE BRONTEKST (BM25)
+# ============================================================================
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text: str) -> list:
+    """Splits tekst in kleine-letter woorden (minimaal 2 tekens) voor lexicale retrieval."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1]
+
+
+def chunk_source_text(text: str, max_chars: int = RETRIEVAL_CHUNK_CHARS) -> list:
+    """
+    Knip de brontekst op in chunks van maximaal max_chars tekens.
+    Paragrafen worden samengevoegd tot een chunk vol is; te lange paragrafen
+    (PDF's zonder witregels) worden op zinsgrenzen gesplitst.
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_PATTERN.split(paragraph):
+            # Ook een enkele zin kan te lang zijn (tabellen, opsommingen)
+            for start in range(0, len(sentence), max_chars):
+                pieces.append(sentence[start:start + max_chars])
+    
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SourceIndex:
+    """Okapi BM25 index over de chunks van één brondocument."""
+    
+    K1 = 1.5
+    B = 0.75
+    
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.postings = {}  # term -> [(chunk_index, term_frequency)]
+        self.chunk_lengths = []
         
-        if isinstance(parsed, dict):
-            for key in ["questions", "vragen", "items", "flashcards", "begrippen"]:
-                if key in parsed and isinstance(parsed[key], list):
-                    return parsed[key]
+        for chunk_index, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            self.chunk_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((chunk_index, frequency))
         
-        if isinstance(parsed, list):
-            return parsed
+        num_chunks = max(len(chunks), 1)
+        self.avg_length = (sum(self.chunk_lengths) / num_chunks) or 1.0
+        self.idf = {
+            term: math.log(1 + (num_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+    
+    def search(self, query: str, top_k: int) -> list:
+        """Geef de indices van de top_k best scorende chunks terug (hoogste score eerst)."""
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for chunk_index, frequency in self.postings[term]:
+                length_norm = self.K1 * (1 - self.B + self.B * self.chunk_lengths[chunk_index] / self.avg_length)
+                scores[chunk_index] = scores.get(chunk_index, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + length_norm)
         
-        return [parsed]
+        ranked = sorted(scores, key=lambda index: (-scores[index], index))
+        return ranked[:top_k]
     
-    except Exception as e:
-        st.error(f"❌ Fout bij JSON parsing: {str(e)}")
-        return None
+    def context_for(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> str:
+        """
+        Bouw de brontekst voor een prompt uit de relevantste chunks, in documentvolgorde.
+        Zonder treffers wordt een gelijkmatige doorsnede van het document gebruikt.
+        """
+        selected = self.search(query, top_k)
+        if not selected and self.chunks:
+            step = max(len(self.chunks) / top_k, 1)
+            selected = sorted({int(i * step) for i in range(min(top_k, len(self.chunks)))})
+        
+        return "\n\n[...]\n\n".join(self.chunks[index] for index in sorted(selected))
 
 
-def construct_system_prompt(study: str, subject: str, book: str = None, mode: str = "practice", num_questions: int = 5, question_type: str = "Mix") -> str:
-    """🧠 SLIMME System Prompt Generator met BOEK-INTEGRATIE en GENEESKUNDE SPECIALISATIE."""
-    field_config = STUDY_FIELDS[study]
-    
-    base_instruction = f"""Je bent een gespecialiseerde AI-trainer voor {study}, maar je bent SPECIFIEK GESPECIALISEERD in {subject}.
+@st.cache_resource(max_entries=32)
+def get_source_index(source_hash: str, _source_text: str) -> SourceIndex:
+    """Bouw de index één keer per brondocument (gedeeld tussen sessies via de hash)."""
+    return SourceIndex(chunk_source_text(_source_text))
 
-🎯 CRUCIALE INSTRUCTIE:
-Je bent niet alleen expert in {study}, je bent GESPECIALISEERD in {subject}. 
-Al je vragen en voorbeelden MOETEN specifiek over {subject} gaan. 
-Wijk hier NIET vanaf. Blijf binnen de grenzen van {subject}."""
-    
-    book_instruction = ""
+
+def build_retrieval_query(subject: str, book: str) -> str:
+    """Zoekvraag voor de bron: het vak, plus het boek alleen als er echt een boek gekozen is."""
     if book and book != "Geen specifiek boek / Algemeen":
-        book_instruction = f"""
+        return f"{subject} {book}"
+    return subject
 
-📚 BOEK-SPECIFIEKE INSTRUCTIE (ZEER BELANGRIJK):
-Baseer je uitleg, structuur en terminologie SPECIFIEK op het boek: '{book}'.
-- Gebruik de definities zoals '{book}' ze hanteert
-- Volg de structuur en opbouw van '{book}'
-- Verwijs naar concepten zoals ze in '{book}' worden uitgelegd
-- Gebruik de terminologie en notatie van '{book}'
-Dit boek is de LEIDENDE bron voor je uitleg en vragen."""
+
+def select_source_context(query: str) -> str:
+    """
+    Geef de brontekst die in een prompt hoort: de volledige tekst voor kleine
+    bronnen, anders alleen de top-k chunks die relevant zijn voor de query.
+    """
+    source_text = st.session_state.source_text
+    if not source_text or len(source_text) <= RETRIEVAL_MIN_SOURCE_CHARS or not st.session_state.source_hash:
+        return source_text
     
-    if mode == "practice":
-        system_prompt = f"""{base_instruction}{book_instruction}
+    source_index = get_source_index(st.session_state.source_hash, source_text)
+    return source_index.context_for(query, RETRIEVAL_TOP_K)
 
-{field_config['role_instruction']}
 
-TECHNISCHE INSTRUCTIES:
-{field_config['tech_instruction']}
+@st.cache_resource
+def get_background_executor() -> ThreadPoolExecutor:
+    """Eén gedeelde thread pool per server proces voor werk buiten de script thread."""
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="studietrainer")
 
-WORKFLOW:
-1. Analyseer de brontekst/afbeelding grondig (of gebruik je kennis van {subject} als er geen bron is)
-2. Stel ÉÉN gerichte vraag SPECIFIEK over {subject}
-3. Wacht op het antwoord van de student
-4. Geef feedback:
-   - Begin met ✅ (correct) of ❌ (fout)
-   - Leg uit waarom het antwoord juist/onjuist is
-   - Geef aanvullende context BINNEN {subject}
-5. Stel een nieuwe, verdiepende vraag over {subject}
 
-BELANGRIJK:
-- Stel telkens maar ÉÉN vraag
-- Houd de vragen STRIKT gericht op {subject}
-- Bouw voort op eerdere antwoorden
-- Pas je niveau aan op basis van de antwoorden
-- Begin ALTIJD feedback met ✅ of ❌ voor score tracking
-"""
+# ============================================================================
+# 📡 GEDEELDE OPENAI CLIENT MET CONNECTION POOL
+# ============================================================================
+
+class ConnectionPoolStats:
+    """
+    Telt HTTP requests en nieuw geopende TCP verbindingen van de gedeelde client.
+    Een request zonder nieuwe verbinding is een hit op de keep-alive pool.
+    """
     
-    elif mode == "exam":
-        # 🏥 FIX 3: GENEESKUNDE SPECIFIEK - Vraagtype instructie
-        question_type_instruction = ""
-        if study == "Geneeskunde 🩺":
-            if question_type == "Klinisch (Casussen)":
-                question_type_instruction = """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+    
+    def on_request(self, request: httpx.Request):
+        """httpx event hook: registreer het request en koppel de trace callback."""
+        request.extensions["trace"] = self._trace
+        with self._lock:
+            self.requests += 1
+    
+    def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "pool_hits": max(self.requests - self.new_connections, 0)
+            }
 
-🏥 VRAAGTYPE: KLINISCH (CASUSSEN)
-FOCUS op klinische casuïstiek:
-- Presenteer patiëntcasussen met symptomen
-- Vraag naar diagnoses, differentiaaldiagnoses
-- Test klinisch redeneren en besluitvorming
-- Gebruik realistische patiëntscenario's
-- Vraag naar behandelingsopties en prognose
 
-Voorbeeld structuur:
-"Een 45-jarige man presenteert zich met [symptomen]. Wat is de meest waarschijnlijke diagnose?"
-"""
-            elif question_type == "Theoretisch (Feiten)":
-                question_type_instruction = """
+@st.cache_resource
+def get_connection_pool_stats() -> ConnectionPoolStats:
+    """Gedeelde verbindingsstatistieken per server proces."""
+    return ConnectionPoolStats()
 
-📚 VRAAGTYPE: THEORETISCH (FEITEN)
-FOCUS op feitelijke kennis:
-- Vraag naar definities en mechanismen
-- Test kennis van anatomie, fysiologie, pathofysiologie
-- Vraag naar oorzaak-gevolg relaties
-- Test kennis van medicijnen en hun werkingsmechanismen
-- Geen casussen, alleen directe kennisvragen
 
-Voorbeeld structuur:
-"Wat is het werkingsmechanisme van [medicijn]?"
-"Welke structuur is verantwoordelijk voor [functie]?"
-"""
-            else:  # Mix
-                question_type_instruction = """
+@st.cache_resource
+def get_shared_openai_client(api_key: str) -> OpenAI:
+    """
+    Eén OpenAI client per API key en server proces, gedeeld door alle sessies
+    en reruns, zodat de HTTP keep-alive verbindingen hergebruikt worden.
+    """
+    pool_stats = get_connection_pool_stats()
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        event_hooks={"request": [pool_stats.on_request]}
+    )
+    # Retries doet de globale scheduler (met backoff en quota), niet de client zelf
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
 
-🔀 VRAAGTYPE: MIX
-Combineer klinische casussen met theoretische vragen.
-- Ongeveer 50% casussen, 50% feitenvragen
-- Varieer de vraagstelling voor een compleet beeld
-"""
-        
-        # 🔧 BUG FIX 2: LaTeX escaping instructie voor JSON
-        latex_escape_instruction = ""
-        if study in ["Engineering & Wiskunde ⚙️", "Economie 📈"] or "Calculus" in subject or "Algebra" in subject:
-            latex_escape_instruction = """
 
-⚠️ CRUCIAAL VOOR JSON MET LaTeX:
-Wanneer je LaTeX formules gebruikt in je vragen of uitleg, moet je ELKE backslash DUBBEL escapen voor correcte JSON parsing.
+# ============================================================================
+# 🗄️ RESPONSE CACHE VOOR GENERATIE ZONDER BESTAND
+# ============================================================================
+
+class ResponseCache:
+    """
+    LRU cache met TTL voor AI responses, geadresseerd op een hash van model,
+    parameters en berichten. Met variants > 1 worden per sleutel eerst K
+    verschillende antwoorden verzameld (misses) en daarna willekeurig hergebruikt.
+    """
+    
+    def __init__(self, max_entries: int, ttl: int, variants: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self._entries = OrderedDict()  # key -> {"created": timestamp, "responses": [...]}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(params: dict, namespace: str) -> str:
+        payload = json.dumps({"namespace": namespace, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        """Geef een gecachete response terug, of None als er (nog) een AI aanroep nodig is."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry["created"] > self.ttl:
+                del self._entries[key]
+                entry = None
+            
+            if entry is None or len(entry["responses"]) < self.variants:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry["responses"])
+    
+    def can_serve(self, key: str) -> bool:
+        """Zou get() nu een response teruggeven? Telt niet mee als hit of miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return (
+                entry is not None and time.time() - entry["created"] <= self.ttl
+                and len(entry["responses"]) >= self.variants
+            )
+    
+    def put(self, key: str, response: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"created": time.time(), "responses": []}
+                self._entries[key] = entry
+            if len(entry["responses"]) < self.variants:
+                entry["responses"].append(response)
+            
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Gedeelde response cache per server proces."""
+    return ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS)
+
+
+# ============================================================================
+# 🚦 GLOBALE LLM SCHEDULER (RATE LIMITS, EERLIJKE WACHTRIJ, BACKOFF)
+# ============================================================================
+
+class TokenBucket:
+    """Token bucket met een capaciteit per minuut die continu wordt bijgevuld."""
+    
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(per_minute, 1))
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconden tot `amount` beschikbaar is (0 = nu)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+    
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class LLMScheduler:
+    """
+    Procesbrede scheduler voor alle AI aanroepen van alle sessies.
+    
+    - Request- en token-per-minuut buckets houden ons binnen het OpenAI quotum
+    - Eerlijke wachtrij: sessies worden round-robin bediend, zodat één sessie met
+      veel batches de rest niet blokkeert
+    - Begrensde concurrency en jittered exponential backoff op 429/5xx/verbindingsfouten
+    - Publiceert wachtrijdiepte en wachttijden voor het dimensioneren van het quotum
+    """
+    
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int, max_retries: int):
+        self.requests_bucket = TokenBucket(rpm)
+        self.tokens_bucket = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session_id -> deque met tickets, volgorde = round-robin
+        self._in_flight = 0
+        self._wait_times = deque(maxlen=500)
+        self.dispatched = 0
+        self.retries = 0
+        self.rate_limited = 0
+    
+    def acquire(self, session_id: str, estimated_tokens: int, cancel_token: "CancelToken" = None) -> float:
+        """
+        Wacht op een beurt in de eerlijke wachtrij en op quotum; geeft de wachttijd terug.
+        🛑 Wordt cancel_token geannuleerd, dan verlaat het ticket de wachtrij zonder quotum
+        te verbruiken (CancelledError).
+        """
+        ticket = object()
+        enqueued_at = time.monotonic()
+        
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    self._drop_ticket(session_id, ticket)
+                    self._cond.notify_all()
+                    raise CancelledError()
+                now = time.monotonic()
+                timeout = None
+                head_session = next(iter(self._queues))
+                if self._queues[head_session][0] is ticket and self._in_flight < self.max_concurrency:
+                    delay = max(
+                        self.requests_bucket.wait_time(1, now),
+                        self.tokens_bucket.wait_time(estimated_tokens, now)
+                    )
+                    if delay <= 0:
+                        break
+                    timeout = delay
+                if cancel_token is not None:
+                    timeout = min(timeout or GENERATION_POLL_SECONDS, GENERATION_POLL_SECONDS)
+                self._cond.wait(timeout=timeout)
+            
+            self.requests_bucket.consume(1)
+            self.tokens_bucket.consume(estimated_tokens)
+            self._in_flight += 1
+            self.dispatched += 1
+            
+            # Round-robin: deze sessie sluit achteraan aan
+            queue = self._queues.pop(session_id)
+            queue.popleft()
+            if queue:
+                self._queues[session_id] = queue
+            
+            waited = time.monotonic() - enqueued_at
+            self._wait_times.append(waited)
+            self._cond.notify_all()
+        return waited
+    
+    def _drop_ticket(self, session_id: str, ticket):
+        queue = self._queues[session_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session_id]
+    
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+    
+    @staticmethod
+    def backoff_delay(attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, maar nooit korter dan een Retry-After header."""
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", 0)))
+            except (TypeError, ValueError):
+                pass
+        return delay
+    
+    def run(self, session_id: str, estimated_tokens: int, call, keep_slot: bool = False, cancel_token: "CancelToken" = None):
+        """
+        Voer `call()` uit binnen het quotum, met retries op tijdelijke fouten.
+        Met keep_slot=True blijft de concurrency-slot bezet (voor streams) en moet
+        de aanroeper zelf release() doen.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(session_id, estimated_tokens, cancel_token)
+            try:
+                result = call()
+            except Exception as error:
+                self.release()
+                if isinstance(error, openai.RateLimitError):
+                    with self._cond:
+                        self.rate_limited += 1
+                if attempt >= self.max_retries or not self.is_retryable(error):
+                    raise
+                with self._cond:
+                    self.retries += 1
+                time.sleep(self.backoff_delay(attempt, error))
+                continue
+            
+            if not keep_slot:
+                self.release()
+            return result
+    
+    def snapshot(self) -> dict:
+        with self._cond:
+            waits = sorted(self._wait_times)
+            return {
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "waiting_sessions": len(self._queues),
+                "in_flight": self._in_flight,
+                "dispatched": self.dispatched,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0
+            }
+
+
+@st.cache_resource
+def get_llm_scheduler() -> LLMScheduler:
+    """Eén scheduler per server proces, gedeeld door alle sessies."""
+    return LLMScheduler(LLM_RPM_LIMIT, LLM_TPM_LIMIT, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES)
+
+
+def current_session_id() -> str:
+    """Streamlit sessie-id van de script thread (achtergrondwerk geeft zijn sessie expliciet mee)."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else "achtergrond"
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    """Ruwe schatting van het aantal prompt tokens (~4 tekens per token)."""
+    prompt_chars = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            prompt_chars += len(content)
+        else:
+            for part in content:
+                # Afbeeldingen tellen als een vaste hoeveelheid tokens
+                prompt_chars += len(part.get("text", "")) if part.get("type") == "text" else 4000
+    return prompt_chars // 4
+
+
+def estimate_request_tokens(params: dict) -> int:
+    """Ruwe schatting van het tokenverbruik (prompt + max output)."""
+    return estimate_prompt_tokens(params["messages"]) + params.get("max_tokens", 0)
+
+
+# ============================================================================
+# 🧾 TOKENGEBRUIK EN PROMPT CACHING (PROVIDER)
+# ============================================================================
+
+class TokenUsageStats:
+    """
+    Tokengebruik en latency per route (modus/model) uit het usage object van de API,
+    inclusief het aantal prompt tokens dat de provider uit zijn prefix-cache haalde.
+    De laatste aanroepen worden los bewaard, zodat besparingen op herhaalde batches
+    zichtbaar zijn. Elke aanroep wordt ook gelogd.
+    """
+    
+    def __init__(self, recent_calls: int):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self.recent = deque(maxlen=recent_calls)
+    
+    def record(self, route: str, usage, seconds: float):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        prompt_tokens = usage.prompt_tokens or 0
+        completion_tokens = usage.completion_tokens or 0
+        logger.info(
+            "route=%s latency=%.2fs prompt_tokens=%d cached_tokens=%d completion_tokens=%d",
+            route, seconds, prompt_tokens, cached_tokens, completion_tokens
+        )
+        
+        with self._lock:
+            totals = self._routes.setdefault(route, {
+                "calls": 0, "seconds": 0.0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0
+            })
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += completion_tokens
+            self.recent.append({"route": route, "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens})
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "routes": {route: dict(totals) for route, totals in self._routes.items()},
+                "recent": list(self.recent)
+            }
+
+
+@st.cache_resource
+def get_token_usage_stats() -> TokenUsageStats:
+    return TokenUsageStats(TOKEN_USAGE_RECENT_CALLS)
+
+
+# ============================================================================
+# ⏱️ DEADLINES EN HEDGING (TAIL LATENCY)
+# ============================================================================
+
+class LatencyHistogram:
+    """Rolling histogram over de laatste `window` metingen, met log-verdeelde buckets (0.25s - ~250s)."""
+    
+    BOUNDS = tuple(0.25 * 1.25 ** i for i in range(32))
+    
+    def __init__(self, window: int):
+        self._samples = deque(maxlen=window)  # bucket-index per meting
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+    
+    def __len__(self):
+        return len(self._samples)
+    
+    def record(self, seconds: float):
+        index = bisect.bisect_left(self.BOUNDS, seconds)
+        if len(self._samples) == self._samples.maxlen:
+            self._counts[self._samples[0]] -= 1
+        self._samples.append(index)
+        self._counts[index] += 1
+    
+    def percentile(self, fraction: float):
+        """Bovengrens van de bucket waarin het gevraagde percentiel valt (None zonder metingen)."""
+        if not self._samples:
+            return None
+        rank = max(1, math.ceil(fraction * len(self._samples)))
+        cumulative = 0
+        for index, count in enumerate(self._counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+
+
+class LatencyTracker:
+    """
+    Houdt per modus de latency-verdeling bij en bewaakt het hedge-budget:
+    het aantal hedges blijft onder HEDGE_MAX_SHARE van alle aanroepen.
+    """
+    
+    def __init__(self, window: int, max_hedge_share: float, min_samples: int):
+        self.window = window
+        self.max_hedge_share = max_hedge_share
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+        self.cancelled = 0
+    
+    def record(self, mode: str, seconds: float):
+        with self._lock:
+            self._histograms.setdefault(mode, LatencyHistogram(self.window)).record(seconds)
+    
+    def hedge_delay(self, mode: str):
+        """De p95 van deze modus, of None zolang er te weinig metingen zijn om te hedgen."""
+        with self._lock:
+            histogram = self._histograms.get(mode)
+            if histogram is None or len(histogram) < self.min_samples:
+                return None
+            return histogram.percentile(0.95)
+    
+    def note_request(self):
+        with self._lock:
+            self.requests += 1
+    
+    def try_reserve_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_share * self.requests:
+                return False
+            self.hedges += 1
+            return True
+    
+    def note_hedge_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+    
+    def note_deadline_exceeded(self):
+        with self._lock:
+            self.deadlines_exceeded += 1
+    
+    def note_cancelled(self):
+        with self._lock:
+            self.cancelled += 1
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "p95": {mode: histogram.percentile(0.95) for mode, histogram in self._histograms.items()},
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "deadlines_exceeded": self.deadlines_exceeded,
+                "cancelled": self.cancelled
+            }
+
+
+@st.cache_resource
+def get_latency_tracker() -> LatencyTracker:
+    return LatencyTracker(LATENCY_WINDOW, HEDGE_MAX_SHARE, HEDGE_MIN_SAMPLES)
+
+
+@st.cache_resource
+def get_llm_attempt_executor() -> ThreadPoolExecutor:
+    """
+    Aparte thread pool voor losse AI pogingen (primair + hedge). Los van de
+    achtergrond pool, zodat wachtende achtergrondtaken nooit hun eigen pogingen blokkeren.
+    """
+    return ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY * 2, thread_name_prefix="llm-poging")
+
+
+# ============================================================================
+# 🛑 ANNULEERBARE GENERATIE (CONTEXT TOKEN)
+# ============================================================================
+
+class CancelToken:
+    """
+    Annuleer-token voor AI aanroepen. Elke sessie heeft een token voor de huidige
+    context (studie, jaar, vak, modus); een kind-token (bv. één tentamen-generatie)
+    geldt ook als geannuleerd zodra zijn ouder geannuleerd is.
+    """
+    
+    def __init__(self, parent: "CancelToken" = None):
+        self.token_id = uuid.uuid4().hex
+        self.parent = parent
+        self._event = threading.Event()
+    
+    def cancel(self):
+        self._event.set()
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+    
+    def child(self) -> "CancelToken":
+        return CancelToken(self)
+
+
+def cancel_generation():
+    """
+    Breek alle lopende generatie van deze sessie af (achtergrond-prefetch, speculatie,
+    samenvattingen, tentamen-batches) en start een nieuwe context. Resultaten van de
+    oude context worden niet meer gebruikt.
+    """
+    if "generation_token" in st.session_state:
+        st.session_state.generation_token.cancel()
+    st.session_state.generation_token = CancelToken()
+    
+    if "prefetcher" in st.session_state:
+        st.session_state.prefetcher.invalidate()
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
+    st.session_state.generation_job = None
+
+
+# ============================================================================
+# 🧵 GENERATIE-JOBS (ACHTERGROND)
+# ============================================================================
+
+class GenerationJob:
+    """
+    Eén generatie (tentamen of flashcard deck) die op de achtergrond draait.
+    Houdt voortgang, deelresultaten en het eindresultaat bij; gebruikt geen Streamlit API's.
+    """
+    
+    def __init__(self, kind: str, total_items: int, cancel_token: CancelToken):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.total_items = total_items
+        self.cancel_token = cancel_token
+        self.status = "running"  # running | done | failed | cancelled
+        self.items = []
+        self.warnings = []  # (niveau, melding): error | warning | info
+        self.result = None
+        self.error = None
+        self.started = time.monotonic()
+        self.finished_at = None
+        self._lock = threading.Lock()
+    
+    def add_items(self, items: list):
+        """Deelresultaat: deze items zijn al binnen (voor de voortgangsweergave)."""
+        with self._lock:
+            self.items.extend(items)
+    
+    def warn(self, message: str, level: str = "warning"):
+        with self._lock:
+            self.warnings.append((level, message))
+    
+    def _finish(self, status: str, result=None, error: str = None):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.monotonic()
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "status": self.status,
+                "items": list(self.items),
+                "total_items": self.total_items,
+                "warnings": list(self.warnings),
+                "result": self.result,
+                "error": self.error,
+                "elapsed": (self.finished_at or time.monotonic()) - self.started
+            }
+
+
+class JobRegistry:
+    """
+    Procesbreed register van generatie-jobs; sessies bewaren alleen het job-id.
+    🧵 Jobs draaien op een eigen thread pool, zodat prefetches en samenvattingen op de
+    gedeelde pool een gestarte generatie niet kunnen ophouden.
+    """
+    
+    def __init__(self, retention: int, workers: int):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="studietrainer-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+    
+    def submit(self, kind: str, total_items: int, cancel_token: CancelToken, work, *args) -> GenerationJob:
+        """Start work(job, *args) op de achtergrond; de return value wordt het resultaat van de job."""
+        job = GenerationJob(kind, total_items, cancel_token)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job, work, args)
+        return job
+    
+    @staticmethod
+    def _run(job: GenerationJob, work, args: tuple):
+        try:
+            job._finish("done", result=work(job, *args))
+        except CancelledError:
+            job._finish("cancelled")
+        except Exception as e:
+            job._finish("failed", error=str(e))
+    
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def _prune(self):
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.retention
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_job_registry() -> JobRegistry:
+    return JobRegistry(JOB_RETENTION_SECONDS, JOB_WORKERS)
+
+
+# ============================================================================
+# 📐 BATCHPLANNER (TENTAMENGENERATIE)
+# ============================================================================
+
+class BatchPlan:
+    """Uitkomst van de planner: vragen per batch, max_tokens per batch en de verwachte duur."""
+    
+    __slots__ = ("batch_sizes", "max_tokens", "predicted_seconds")
+    
+    def __init__(self, batch_sizes: list, max_tokens: int, predicted_seconds: float):
+        self.batch_sizes = batch_sizes
+        self.max_tokens = max_tokens
+        self.predicted_seconds = predicted_seconds
+
+
+class BatchPlanner:
+    """
+    📐 Kiest batchgrootte en max_tokens per batch voor tentamengeneratie.
+    
+    - Output tokens per vraag worden per (studie, vraagtype) gemeten: een klinische casus
+      is veel langer dan een feitenvraag
+    - Doorvoer: tijd tot de eerste tekst en seconden per output token, over alle batches
+    - Het aantal batches minimaliseert de verwachte totale duur bij max `concurrency`
+      batches tegelijk (in golven); binnen BATCH_PLAN_TOLERANCE van de snelste duur
+      wint het kleinste aantal aanroepen
+    - max_tokens = batchgrootte × tokens per vraag × marge; de marge groeit na een
+      afgekapte batch en zakt langzaam terug na complete batches
+    Beslissingen en uitkomsten worden gelogd via de "studietrainer" logger.
+    """
+    
+    EWMA_ALPHA = 0.3
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self.ttft = 1.0
+        self.seconds_per_token = 1 / 60
+        self.plans = 0
+        self.batches = 0
+        self.truncations = 0
+    
+    def _profile(self, study: str, question_type: str) -> dict:
+        return self._profiles.setdefault((study, question_type), {
+            "tokens_per_question": float(EXAM_TOKENS_PER_QUESTION), "margin": BATCH_TOKEN_MARGIN,
+            "samples": 0, "truncations": 0
+        })
+    
+    def plan(self, study: str, question_type: str, num_questions: int, concurrency: int, max_tokens_cap: int, record: bool = True) -> BatchPlan:
+        """Met record=False alleen voorspellen: niet geteld en niet gelogd."""
+        with self._lock:
+            profile = dict(self._profile(study, question_type))
+            ttft, seconds_per_token = self.ttft, self.seconds_per_token
+            if record:
+                self.plans += 1
+        
+        tokens_per_question = profile["tokens_per_question"]
+        budget_per_question = tokens_per_question * profile["margin"]
+        largest = int((max_tokens_cap - BATCH_ENVELOPE_TOKENS) // budget_per_question)
+        largest = max(1, min(EXAM_MAX_BATCH_SIZE, num_questions, largest))
+        fewest_batches = math.ceil(num_questions / largest)
+        most_batches = max(fewest_batches, num_questions // min(EXAM_MIN_BATCH_SIZE, largest))
+        
+        candidates = []
+        for num_batches in range(fewest_batches, most_batches + 1):
+            size = math.ceil(num_questions / num_batches)
+            waves = math.ceil(num_batches / concurrency)
+            candidates.append((waves * (ttft + size * tokens_per_question * seconds_per_token), num_batches, size))
+        fastest = min(seconds for seconds, _, _ in candidates)
+        seconds, num_batches, size = next(
+            candidate for candidate in candidates if candidate[0] <= fastest * (1 + BATCH_PLAN_TOLERANCE)
+        )
+        # Gelijk verdeeld (12 vragen in 3 batches = 4/4/4, niet 5/5/2)
+        batch_sizes = [num_questions // num_batches + (1 if index < num_questions % num_batches else 0) for index in range(num_batches)]
+        # Afgerond op 256, zodat gecachete responses niet bij elke kleine bijstelling verlopen
+        max_tokens = min(max_tokens_cap, math.ceil((size * budget_per_question + BATCH_ENVELOPE_TOKENS) / 256) * 256)
+        
+        if record:
+            logger.info(
+                "exam plan study=%s type=%s questions=%d batches=%s max_tokens=%d tokens_per_question=%.0f margin=%.2f predicted=%.1fs",
+                study, question_type, num_questions, batch_sizes, max_tokens, tokens_per_question, profile["margin"], seconds
+            )
+        return BatchPlan(batch_sizes, max_tokens, seconds)
+    
+    def observe(self, study: str, question_type: str, requested: int, items_seen: int, output_tokens: float, truncated: bool, seconds: float, ttft):
+        """Verwerk de uitkomst van één batch (ttft is None bij een cache hit)."""
+        with self._lock:
+            profile = self._profile(study, question_type)
+            if items_seen:
+                # De eerste meting vervangt de standaardwaarde
+                alpha = max(self.EWMA_ALPHA, 1 / (profile["samples"] + 1))
+                profile["tokens_per_question"] += alpha * (output_tokens / items_seen - profile["tokens_per_question"])
+                profile["samples"] += 1
+            if truncated:
+                profile["margin"] = min(BATCH_TOKEN_MARGIN_MAX, profile["margin"] * 1.25)
+                profile["truncations"] += 1
+                self.truncations += 1
+            else:
+                profile["margin"] = max(BATCH_TOKEN_MARGIN, profile["margin"] * 0.98)
+            if ttft is not None:
+                self.ttft += self.EWMA_ALPHA * (ttft - self.ttft)
+                if output_tokens > 0 and seconds > ttft:
+                    self.seconds_per_token += self.EWMA_ALPHA * ((seconds - ttft) / output_tokens - self.seconds_per_token)
+            self.batches += 1
+        
+        logger.info(
+            "exam batch study=%s type=%s requested=%d received=%d output_tokens=%.0f truncated=%s latency=%.1fs ttft=%s",
+            study, question_type, requested, items_seen, output_tokens, truncated, seconds,
+            "cache" if ttft is None else f"{ttft:.1f}s"
+        )
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "profiles": {key: dict(profile) for key, profile in self._profiles.items()},
+                "ttft": self.ttft,
+                "tokens_per_second": 1 / self.seconds_per_token,
+                "plans": self.plans,
+                "batches": self.batches,
+                "truncations": self.truncations
+            }
+
+
+@st.cache_resource
+def get_batch_planner() -> BatchPlanner:
+    """Gedeelde batchplanner per server proces (metingen van alle sessies samen)."""
+    return BatchPlanner()
+
+
+# ============================================================================
+# 🧬 BIJNA-DUPLICATEN (MINHASH / LSH)
+# ============================================================================
+
+MINHASH_PRIME = np.uint64((1 << 61) - 1)
+MINHASH_MAX_HASH = np.uint64(0xFFFFFFFF)
+# Vaste seed: signatures en band-sleutels moeten over processen heen gelijk zijn (ze staan in de vragenbank)
+_minhash_random = np.random.RandomState(20240601)
+MINHASH_A = _minhash_random.randint(1, 1 << 32, size=(MINHASH_PERMUTATIONS, 1), dtype=np.uint64)
+MINHASH_B = _minhash_random.randint(0, 1 << 32, size=(MINHASH_PERMUTATIONS, 1), dtype=np.uint64)
+_NON_WORD_PATTERN = re.compile(r"[\W_]+")
+_OPTION_LABEL_PATTERN = re.compile(r"^[A-Da-d][).]\s*")
+
+
+def near_duplicate_text(item: dict) -> str:
+    """Genormaliseerde tekst voor de duplicaat-vergelijking: vraag + correct antwoord (of term + definitie)."""
+    if "vraag" in item:
+        parts = [item.get("vraag", ""), _OPTION_LABEL_PATTERN.sub("", str(item.get("correct_antwoord", "")))]
+    else:
+        parts = [item.get("term", ""), item.get("definitie", "")]
+    return _NON_WORD_PATTERN.sub(" ", " ".join(str(part) for part in parts).lower()).strip()
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """MinHash signature (uint32) over de karakter-shingles van een genormaliseerde tekst."""
+    data = text.encode("utf-8")
+    size = MINHASH_SHINGLE_SIZE
+    shingles = np.fromiter(
+        {zlib.crc32(data[i:i + size]) for i in range(max(1, len(data) - size + 1))}, dtype=np.uint64
+    )
+    hashes = (MINHASH_A * shingles + MINHASH_B) % MINHASH_PRIME & MINHASH_MAX_HASH
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def minhash_similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+    """Geschatte Jaccard-gelijkenis: het aandeel gelijke MinHash waarden."""
+    return np.count_nonzero(signature_a == signature_b) / MINHASH_PERMUTATIONS
+
+
+def lsh_band_keys(signature: np.ndarray, scope: str = "") -> list:
+    """
+    Eén 64-bit sleutel per LSH band. Items die in minstens één band gelijk zijn, zijn kandidaat.
+    De scope (bv. soort + vragenbank-sleutel) zit in de sleutel, zodat kandidaten alleen binnen
+    dezelfde selectie gezocht worden.
+    """
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    prefix = scope.encode("utf-8")
+    return [
+        int.from_bytes(hashlib.blake2b(
+            prefix + bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes(),
+            digest_size=8
+        ).digest(), "big", signed=True)
+        for band in range(LSH_BANDS)
+    ]
+
+
+class NearDuplicateIndex:
+    """In-memory LSH index die bijna-duplicaten binnen één tentamen of deck herkent (thread-safe)."""
+    
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._signatures = []
+    
+    def add(self, item: dict) -> bool:
+        """Voeg een item toe; False (en niet toegevoegd) als het een bijna-duplicaat is."""
+        signature = minhash_signature(near_duplicate_text(item))
+        keys = lsh_band_keys(signature)
+        with self._lock:
+            candidates = {index for key in keys for index in self._buckets.get(key, ())}
+            if any(minhash_similarity(signature, self._signatures[index]) >= self.threshold for index in candidates):
+                return False
+            self._signatures.append(signature)
+            for key in keys:
+                self._buckets.setdefault(key, []).append(len(self._signatures) - 1)
+        return True
+    
+    def filter(self, items: list) -> list:
+        """De items die geen bijna-duplicaat zijn van wat al in de index staat (in volgorde)."""
+        return [item for item in items if self.add(item)]
+
+
+# ============================================================================
+# 🏦 VRAGENBANK (SQLITE)
+# ============================================================================
+
+class QuestionBank:
+    """
+    Persistente opslag van gegenereerde tentamenvragen en flashcards.
+    
+    - Geïndexeerd op (soort, studie, jaar, vak, boek, vraagtype, bron-hash) en op bron-hash
+    - Exacte duplicaten zijn uniek per selectie: hetzelfde item mag bij een ander vak of bron opnieuw
+    - Willekeurige sampling via een geïndexeerde 'rand' kolom (range scan vanaf een
+      willekeurig startpunt), zodat ook miljoenen items snel blijven
+    - Per gebruiker worden geziene items uitgesloten via een (user_id, item_id) primary key
+    - Bijna-duplicaten binnen dezelfde selectie worden bij het opslaan herkend via
+      MinHash signatures en LSH band-sleutels (geïndexeerd, dus ook snel bij 100.000+ items)
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            study TEXT NOT NULL,
+            year TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            book TEXT NOT NULL,
+            question_type TEXT NOT NULL,
+            source_hash TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            rand REAL NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE (kind, study, year, subject, book, question_type, source_hash, content_hash)
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_lookup
+            ON items (kind, study, year, subject, book, question_type, source_hash, rand);
+        CREATE INDEX IF NOT EXISTS idx_items_source_hash ON items (source_hash);
+        CREATE TABLE IF NOT EXISTS seen (
+            user_id TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (user_id, item_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS item_signatures (
+            item_id INTEGER PRIMARY KEY,
+            signature BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS item_bands (
+            band_key INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            PRIMARY KEY (band_key, item_id)
+        ) WITHOUT ROWID;
+    """
+    
+    FILTER_COLUMNS = ("study", "year", "subject", "book", "question_type", "source_hash")
+    
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self.near_duplicates = 0
+    
+    @staticmethod
+    def content_hash(item: dict) -> str:
+        return hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    
+    def sample(self, kind: str, filters: dict, user_id: str, limit: int) -> list:
+        """Trek maximaal `limit` willekeurige, door deze gebruiker nog niet geziene items: [(id, item)]."""
+        where = " AND ".join(f"{column} = ?" for column in self.FILTER_COLUMNS)
+        values = [filters[column] for column in self.FILTER_COLUMNS]
+        query = f"""
+            SELECT id, payload FROM items
+            WHERE kind = ? AND {where} AND rand {{op}} ?
+              AND NOT EXISTS (SELECT 1 FROM seen WHERE seen.user_id = ? AND seen.item_id = items.id)
+            ORDER BY rand LIMIT ?
+        """
+        pivot = random.random()
+        
+        with self._lock:
+            rows = self._conn.execute(query.format(op=">="), [kind, *values, pivot, user_id, limit]).fetchall()
+            if len(rows) < limit:
+                # Wrap-around: vul aan met items vóór het startpunt
+                rows += self._conn.execute(query.format(op="<"), [kind, *values, pivot, user_id, limit - len(rows)]).fetchall()
+        
+        return [(item_id, json.loads(payload)) for item_id, payload in rows]
+    
+    def _find_near_duplicate(self, signature: np.ndarray, band_keys: list):
+        """Id van een opgeslagen bijna-duplicaat (via de LSH band-index), of None."""
+        placeholders = ", ".join("?" for _ in band_keys)
+        candidates = self._conn.execute(
+            f"""SELECT DISTINCT s.item_id, s.signature FROM item_bands b
+                JOIN item_signatures s ON s.item_id = b.item_id
+                WHERE b.band_key IN ({placeholders})""",
+            band_keys
+        ).fetchall()
+        for item_id, blob in candidates:
+            if minhash_similarity(signature, np.frombuffer(blob, dtype=np.uint32)) >= NEAR_DUPLICATE_THRESHOLD:
+                return item_id
+        return None
+    
+    def add(self, kind: str, filters: dict, items: list) -> list:
+        """
+        Sla nieuwe items op en geef hun ids terug in dezelfde volgorde. Exacte duplicaten en
+        bijna-duplicaten binnen dezelfde selectie worden niet opgeslagen; zij krijgen het id
+        van het item dat al in de bank staat.
+        """
+        now = time.time()
+        filter_values = [filters[column] for column in self.FILTER_COLUMNS]
+        scope = "\x1f".join([kind, *filter_values])
+        signatures = [minhash_signature(near_duplicate_text(item)) for item in items]
+        
+        ids = []
+        with self._lock, self._conn:
+            for item, signature in zip(items, signatures):
+                band_keys = lsh_band_keys(signature, scope)
+                duplicate_id = self._find_near_duplicate(signature, band_keys)
+                if duplicate_id is not None:
+                    self.near_duplicates += 1
+                    ids.append(duplicate_id)
+                    continue
+                
+                content_hash = self.content_hash(item)
+                cursor = self._conn.execute(
+                    f"""INSERT OR IGNORE INTO items
+                        (kind, {", ".join(self.FILTER_COLUMNS)}, content_hash, payload, rand, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (kind, *filter_values, content_hash, json.dumps(item, ensure_ascii=False), random.random(), now)
+                )
+                item_id = cursor.lastrowid if cursor.rowcount else self._conn.execute(
+                    f"""SELECT id FROM items WHERE kind = ? AND {" AND ".join(f"{column} = ?" for column in self.FILTER_COLUMNS)}
+                        AND content_hash = ?""",
+                    (kind, *filter_values, content_hash)
+                ).fetchone()[0]
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO item_signatures (item_id, signature) VALUES (?, ?)",
+                    (item_id, signature.tobytes())
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO item_bands (band_key, item_id) VALUES (?, ?)",
+                    [(band_key, item_id) for band_key in band_keys]
+                )
+                ids.append(item_id)
+        
+        return ids
+    
+    def mark_seen(self, user_id: str, item_ids: list):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO seen (user_id, item_id, seen_at) VALUES (?, ?, ?)",
+                [(user_id, item_id, now) for item_id in item_ids if item_id is not None]
+            )
+    
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+
+@st.cache_resource
+def get_question_bank():
+    """Gedeelde vragenbank per server proces (None als uitgeschakeld of niet te openen)."""
+    if not QUESTION_BANK_ENABLED:
+        return None
+    try:
+        return QuestionBank(QUESTION_BANK_PATH)
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def get_bank_filters(study: str, subject: str, book: str, question_type: str = "") -> dict:
+    """De vragenbank-sleutel voor de huidige selectie en het huidige brondocument."""
+    return {
+        "study": study,
+        "year": st.session_state.selected_year,
+        "subject": subject,
+        "book": book or "",
+        "question_type": question_type or "",
+        "source_hash": st.session_state.source_hash or ""
+    }
+
+
+def take_from_bank(kind: str, filters: dict, limit: int) -> list:
+    """Haal ongeziene items uit de vragenbank voor deze gebruiker: [(id, item)]."""
+    question_bank = get_question_bank()
+    if question_bank is None or limit <= 0:
+        return []
+    try:
+        return question_bank.sample(kind, filters, st.session_state.user_id, limit)
+    except sqlite3.Error:
+        return []
+
+
+def store_in_bank(kind: str, filters: dict, banked: list, new_items: list):
+    """Sla nieuwe items op en markeer alle uitgeserveerde items als gezien door deze gebruiker."""
+    question_bank = get_question_bank()
+    if question_bank is None:
+        return
+    try:
+        new_ids = question_bank.add(kind, filters, new_items) if new_items else []
+        question_bank.mark_seen(st.session_state.user_id, [item_id for item_id, _ in banked] + new_ids)
+    except sqlite3.Error:
+        pass  # De vragenbank is een optimalisatie; de sessie werkt ook zonder
+
+
+def render_performance_stats():
+    """📊 Klein beheerpaneel met prestatie-statistieken (alleen als SHOW_PERF_STATS=1)."""
+    if not SHOW_PERF_STATS:
+        return
+    
+    with st.expander("📊 Prestaties (beheer)"):
+        pool = get_connection_pool_stats().snapshot()
+        st.markdown("**📡 OpenAI verbindingen**")
+        st.caption(
+            f"Requests: {pool['requests']} · Pool hits: {pool['pool_hits']} · "
+            f"Nieuwe verbindingen: {pool['new_connections']}"
+        )
+        
+        scheduler = get_llm_scheduler().snapshot()
+        st.markdown("**🚦 LLM scheduler**")
+        st.caption(
+            f"Wachtrij: {scheduler['queue_depth']} ({scheduler['waiting_sessions']} sessies) · "
+            f"Actief: {scheduler['in_flight']} · Verstuurd: {scheduler['dispatched']} · "
+            f"Wachttijd gem/p95: {scheduler['avg_wait']:.2f}s / {scheduler['p95_wait']:.2f}s · "
+            f"429's: {scheduler['rate_limited']} · Retries: {scheduler['retries']}"
+        )
+        
+        latency = get_latency_tracker().snapshot()
+        st.markdown("**⏱️ Latency en hedging**")
+        st.caption(
+            " · ".join(f"p95 {mode}: {p95:.1f}s" for mode, p95 in latency["p95"].items()) or "Nog geen metingen"
+        )
+        st.caption(
+            f"Aanroepen: {latency['requests']} · Hedges: {latency['hedges']} "
+            f"(gewonnen: {latency['hedge_wins']}) · Deadline overschreden: {latency['deadlines_exceeded']} · "
+            f"Afgebroken: {latency['cancelled']}"
+        )
+        
+        cache = get_response_cache().snapshot()
+        st.markdown("**🗄️ Response cache**")
+        st.caption(
+            f"Hits: {cache['hits']} · Misses: {cache['misses']} · "
+            f"Hit rate: {cache['hit_rate']:.0%} · Entries: {cache['entries']}"
+        )
+        
+        usage = get_token_usage_stats().snapshot()
+        st.markdown("**🧾 Routes, tokens en prompt caching**")
+        for route, totals in usage["routes"].items():
+            cached_share = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+            st.caption(
+                f"{route}: {totals['calls']} aanroepen · Gem. latency: {totals['seconds'] / totals['calls']:.1f}s · "
+                f"Prompt: {totals['prompt_tokens']} (gecachet: {totals['cached_tokens']}, {cached_share:.0%}) · "
+                f"Output: {totals['completion_tokens']}"
+            )
+        if usage["recent"]:
+            st.caption("Laatste aanroepen (gecachet/prompt): " + ", ".join(
+                f"{call['route']} {call['cached_tokens']}/{call['prompt_tokens']}" for call in reversed(usage["recent"])
+            ))
+        
+        prompts = get_prompt_cache().snapshot()
+        st.markdown("**🧠 Prompt cache**")
+        st.caption(f"Hits: {prompts['hits']} · Misses: {prompts['misses']} · Entries: {prompts['entries']}")
+        
+        planner = get_batch_planner().snapshot()
+        st.markdown("**📐 Batchplanner**")
+        st.caption(
+            f"Plannen: {planner['plans']} · Batches: {planner['batches']} · Afgekapt: {planner['truncations']} · "
+            f"Eerste tekst: {planner['ttft']:.1f}s · {planner['tokens_per_second']:.0f} tokens/s"
+        )
+        for (study, question_type), profile in planner["profiles"].items():
+            st.caption(
+                f"{study} / {question_type}: {profile['tokens_per_question']:.0f} tokens/vraag · "
+                f"marge {profile['margin']:.2f} · {profile['samples']} metingen · {profile['truncations']} afgekapt"
+            )
+        
+        question_bank = get_question_bank()
+        if question_bank is not None:
+            st.markdown("**🏦 Vragenbank**")
+            st.caption(f"Opgeslagen items: {question_bank.count()} · Bijna-duplicaten geweigerd: {question_bank.near_duplicates}")
+
+
+# ============================================================================
+# 🔧 HELPER FUNCTIES
+# ============================================================================
+
+def resolve_user_id() -> str:
+    """
+    Stabiele gebruikers-id voor de 'al gezien' administratie van de vragenbank.
+    Met een login (st.login) is dat een hash van het e-mailadres; anders een anonieme id
+    in de URL (?uid=...), zodat hij een herlaadactie of bladwijzer overleeft.
+    """
+    try:
+        if st.user.is_logged_in and st.user.get("email"):
+            return hashlib.sha256(st.user.email.encode("utf-8")).hexdigest()[:32]
+    except Exception:
+        pass  # Geen authenticatie geconfigureerd (of een oudere Streamlit zonder st.user)
+    
+    user_id = st.query_params.get("uid", "")
+    if not re.fullmatch(r"[0-9a-f]{32}", user_id):
+        user_id = uuid.uuid4().hex
+        st.query_params["uid"] = user_id
+    return user_id
+
+
+def initialize_session_state():
+    """Initialiseer alle session state variabelen."""
+    if "user_id" not in st.session_state:
+        st.session_state.user_id = resolve_user_id()
+    if "selected_major" not in st.session_state:
+        st.session_state.selected_major = "Geneeskunde 🩺"
+    if "selected_year" not in st.session_state:
+        st.session_state.selected_year = "Jaar 1: De Basis"
+    if "selected_subject" not in st.session_state:
+        first_year = list(STUDY_FIELDS["Geneeskunde 🩺"]["years"].keys())[0]
+        st.session_state.selected_subject = STUDY_FIELDS["Geneeskunde 🩺"]["years"][first_year]["sub_subjects"][0]
+    if "selected_book" not in st.session_state:
+        st.session_state.selected_book = "Geen specifiek boek / Algemeen"
+    if "study_mode" not in st.session_state:
+        st.session_state.study_mode = "🟢 Oefenen"
+    if "exam_num_questions" not in st.session_state:
+        st.session_state.exam_num_questions = 5
+    if "exam_question_type" not in st.session_state:
+        st.session_state.exam_question_type = "Mix"
+    if "skip_mode_reset" not in st.session_state:
+        st.session_state.skip_mode_reset = False
+    if "trigger_ai_response" not in st.session_state:
+        st.session_state.trigger_ai_response = False
+    if "history" not in st.session_state:
+        st.session_state.history = []
+    if "prefetcher" not in st.session_state:
+        st.session_state.prefetcher = QuestionPrefetcher()
+    if "generation_token" not in st.session_state:
+        st.session_state.generation_token = CancelToken()
+    if "generation_job" not in st.session_state:
+        st.session_state.generation_job = None
+    if "notices" not in st.session_state:
+        st.session_state.notices = []
+    if "history_summary" not in st.session_state:
+        st.session_state.history_summary = ""
+    if "summarized_count" not in st.session_state:
+        st.session_state.summarized_count = 0
+    if "summary_job" not in st.session_state:
+        st.session_state.summary_job = None
+    if "speculative_practice" not in st.session_state:
+        st.session_state.speculative_practice = PRACTICE_SPECULATIVE_DEFAULT
+    if "speculative_question" not in st.session_state:
+        st.session_state.speculative_question = None
+    if "context_set" not in st.session_state:
+        st.session_state.context_set = False
+    if "source_text" not in st.session_state:
+        st.session_state.source_text = ""
+    if "source_hash" not in st.session_state:
+        st.session_state.source_hash = None
+    if "image_base64" not in st.session_state:
+        st.session_state.image_base64 = None
+    if "file_type" not in st.session_state:
+        st.session_state.file_type = None
+    if "score" not in st.session_state:
+        st.session_state.score = 0
+    if "total_questions" not in st.session_state:
+        st.session_state.total_questions = 0
+    if "exam_questions" not in st.session_state:
+        st.session_state.exam_questions = []
+    if "exam_history" not in st.session_state:
+        # Alle tentamenvragen die deze sessie al voorbijkwamen (voor de duplicaat-index)
+        st.session_state.exam_history = []
+    if "exam_answers" not in st.session_state:
+        st.session_state.exam_answers = {}
+    if "exam_completed" not in st.session_state:
+        st.session_state.exam_completed = False
+    if "flashcards" not in st.session_state:
+        st.session_state.flashcards = []
+    if "current_flashcard_index" not in st.session_state:
+        st.session_state.current_flashcard_index = 0
+    if "show_flashcard_answer" not in st.session_state:
+        st.session_state.show_flashcard_answer = False
+
+
+def get_openai_client():
+    """Haal de gedeelde OpenAI client op of toon error."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    
+    if not api_key:
+        try:
+            api_key = st.secrets["OPENAI_API_KEY"]
+        except:
+            pass
+    
+    if not api_key:
+        st.error("❌ OPENAI_API_KEY niet gevonden. Voeg deze toe aan .env bestand of Streamlit secrets.")
+        st.stop()
+    
+    return get_shared_openai_client(api_key)
+
+
+def compute_file_hash(data: bytes) -> str:
+    """SHA-256 van de bestandsbytes, gebruikt als cache-sleutel."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def extract_text_from_pdf(pdf_file) -> dict:
+    """
+    Extraheer tekst uit een PDF bestand.
+    💾 Herhaalde uploads van dezelfde PDF worden uit de cache gehaald zonder te parsen.
+    ⚡ Grote PDF's worden per paginareeks parallel verwerkt in een process pool.
+    Geeft een dict met tekst, aantal pagina's, hash en timing-statistieken terug.
+    """
+    result = {"text": "", "num_pages": 0, "source_hash": None, "elapsed": 0.0, "method": "serieel"}
+    start_time = time.perf_counter()
+    
+    try:
+        pdf_bytes = pdf_file.getvalue()
+        digest = compute_file_hash(pdf_bytes)
+        result["source_hash"] = digest
+        
+        pdf_cache = get_pdf_text_cache()
+        cached = pdf_cache.get(digest)
+        if cached is not None:
+            result.update(text=cached[0], num_pages=cached[1], method="cache")
+            result["elapsed"] = time.perf_counter() - start_time
+            return result
+        
+        pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+        num_pages = len(pdf_reader.pages)
+        
+        text_parts = None
+        if num_pages >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_WORKERS > 1:
+            try:
+                text_parts = extract_pages_parallel(pdf_bytes, num_pages)
+                result["method"] = f"parallel ({PDF_EXTRACT_WORKERS} processen)"
+            except Exception:
+                text_parts = None  # Val terug op seriële extractie
+        
+        if text_parts is None:
+            text_parts = []
+            for page in pdf_reader.pages:
+                text_parts.append(page.extract_text())
+        
+        extracted_text = "\n".join(text_parts)
+        pdf_cache.put(digest, extracted_text, num_pages)
+        
+        result.update(text=extracted_text, num_pages=num_pages)
+        result["elapsed"] = time.perf_counter() - start_time
+        return result
+    except Exception as e:
+        st.error(f"❌ Fout bij het lezen van PDF: {str(e)}")
+        return result
+
+
+def encode_image(image_file) -> str:
+    """Encode een afbeelding naar base64 string."""
+    return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+JSON_ITEM_KEYS = ["questions", "vragen", "items", "flashcards", "begrippen"]
+JSON_ESCAPE_PATTERN = re.compile(r'\\(u[0-9a-fA-F]{4}|.?)', re.DOTALL)
+JSON_TRAILING_COMMA_PATTERN = re.compile(r',\s*([}\]])')
+JSON_STRUCTURE_PATTERN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}]', re.DOTALL)
+JSON_ITEMS_START_PATTERN = re.compile(r'"(?:' + "|".join(JSON_ITEM_KEYS) + r')"\s*:\s*\[')
+
+
+def repair_json_text(text: str) -> str:
+    """
+    🩹 Herstel veelvoorkomende JSON fouten van het model:
+    ongeldige escapes (LaTeX zoals \\int, \\sqrt of \\frac) en komma's vóór } of ].
+    """
+    def fix_escape(match):
+        escaped = match.group(1)
+        if escaped.startswith("u") and len(escaped) == 5 or escaped in ('"', "\\", "/"):
+            return match.group(0)
+        # \b \f \n \r \t gevolgd door een letter is een LaTeX commando (\frac, \beta, \theta), geen escape
+        next_char = match.string[match.end():match.end() + 1]
+        if escaped in ("b", "f", "n", "r", "t") and not (next_char.isascii() and next_char.isalpha()):
+            return match.group(0)
+        return "\\\\" + escaped
+    
+    text = JSON_ESCAPE_PATTERN.sub(fix_escape, text)
+    return JSON_TRAILING_COMMA_PATTERN.sub(r'\1', text)
+
+
+def json_object_end(text: str, start: int):
+    """Positie net na het object dat op start begint (strings worden overgeslagen), of None als het afgekapt is."""
+    depth = 0
+    for token in JSON_STRUCTURE_PATTERN.finditer(text, start):
+        if token.group() == "{":
+            depth += 1
+        elif token.group() == "}":
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return None
+
+
+def salvage_json_items(text: str) -> list:
+    """
+    Haal alle complete objecten uit de item-lijst van een (afgekapt) JSON antwoord,
+    bv. wanneer de response halverwege de laatste vraag op max_tokens stopte.
+    Alleen een object dat zelf niet te parsen is wordt hersteld, zodat geldige
+    escapes (zoals \\n) in de andere objecten blijven staan.
+    """
+    match = JSON_ITEMS_START_PATTERN.search(text) or re.search(r'\[', text)
+    if not match:
+        return []
+    
+    items = []
+    position = match.end()
+    while True:
+        while position < len(text) and text[position] in " \t\r\n,":
+            position += 1
+        if position >= len(text) or text[position] != "{":
+            break
+        end = json_object_end(text, position)
+        if end is None:
+            break  # Afgekapt object
+        # Per object decoderen: een fout in de hele tekst kost telkens een lineaire regelnummer-telling
+        item = StreamingItemParser.decode_item(text[position:end])
+        if item is not None:
+            items.append(item)
+        position = end
+    return items
+
+
+class StreamingItemParser:
+    """
+    Incrementele parser voor een gestreamde JSON response: geeft elk object uit de
+    item-lijst terug zodra de afsluitende accolade binnen is, zonder op de rest te wachten.
+    items_seen telt ook objecten die niet te parsen waren, zodat het na afloop gelijk
+    loopt met de positie in de volledige lijst.
+    """
+    
+    def __init__(self):
+        self.items_seen = 0
+        self._text = ""
+        self._position = 0
+        self._list_started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._item_start = 0
+    
+    def feed(self, chunk: str) -> list:
+        """Voeg een stuk tekst toe en geef de objecten terug die daarmee compleet zijn."""
+        self._text += chunk
+        if self._finished:
+            return []
+        if not self._list_started:
+            match = JSON_ITEMS_START_PATTERN.search(self._text)
+            if not match:
+                return []
+            self._list_started = True
+            self._position = match.end()
+        
+        items = []
+        text = self._text
+        for index in range(self._position, len(text)):
+            char = text[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._item_start = index
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.items_seen += 1
+                    item = self.decode_item(text[self._item_start:index + 1])
+                    if item is not None:
+                        items.append(item)
+            elif char == "]" and self._depth == 0:
+                self._finished = True
+                break
+        self._position = len(text)
+        return items
+    
+    @staticmethod
+    def decode_item(text: str):
+        """Eén object; alleen als het zelf ongeldig is, wordt het hersteld (None als ook dat faalt)."""
+        try:
+            return json.loads(text, strict=False)
+        except ValueError:
+            try:
+                return json.loads(repair_json_text(text), strict=False)
+            except ValueError:
+                return None
+
+
+def parse_json_items(response_text: str):
+    """
+    Parse JSON response van AI naar een lijst items.
+    Bij ongeldige JSON wordt eerst per object gered wat compleet is (alleen kapotte objecten
+    worden hersteld); pas als er geen item-lijst is, wordt de hele tekst hersteld.
+    Gooit alleen een exception als er niets bruikbaars overblijft.
+    Gebruikt geen Streamlit API's (veilig in threads).
+    """
+    text = response_text.strip()
+    if "```" in text:
+        text = re.sub(r'^```(?:json)?\s*', '', text, flags=re.MULTILINE)
+        text = re.sub(r'\s*```$', '', text, flags=re.MULTILINE)
+        text = text.strip()
+    
+    try:
+        parsed = json.loads(text, strict=False)
+    except ValueError as error:
+        items = salvage_json_items(text)
+        if items:
+            return items
+        try:
+            parsed = json.loads(repair_json_text(text), strict=False)
+        except ValueError:
+            raise error
+    
+    if isinstance(parsed, dict):
+        for key in JSON_ITEM_KEYS:
+            if key in parsed and isinstance(parsed[key], list):
+                return parsed[key]
+    
+    if isinstance(parsed, list):
+        return parsed
+    
+    return [parsed]
+
+
+class ExamQuestion:
+    """
+    ✅ Gevalideerde tentamenvraag: een vraag, 4 verschillende opties, een correct_antwoord
+    dat één van de opties is en een niet-lege uitleg.
+    """
+    
+    __slots__ = ("vraag", "opties", "correct_antwoord", "uitleg")
+    
+    LIST_KEY = "questions"
+    SCHEMA = {
+        "type": "object",
+        "properties": {
+            "vraag": {"type": "string"},
+            "opties": {"type": "array", "items": {"type": "string"}, "minItems": 4, "maxItems": 4},
+            "correct_antwoord": {"type": "string"},
+            "uitleg": {"type": "string"}
+        },
+        "required": ["vraag", "opties", "correct_antwoord", "uitleg"],
+        "additionalProperties": False
+    }
+    
+    def __init__(self, vraag: str, opties: list, correct_antwoord: str, uitleg: str):
+        self.vraag = vraag
+        self.opties = opties
+        self.correct_antwoord = correct_antwoord
+        self.uitleg = uitleg
+    
+    @classmethod
+    def from_dict(cls, data):
+        """Valideer en normaliseer; een los letter-antwoord ("B") wordt de bijbehorende optie. None bij een ongeldige vraag."""
+        if not isinstance(data, dict):
+            return None
+        
+        vraag = str(data.get("vraag") or "").strip()
+        uitleg = str(data.get("uitleg") or "").strip()
+        opties = data.get("opties")
+        if not vraag or not uitleg or not isinstance(opties, list) or len(opties) != 4:
+            return None
+        opties = [str(optie).strip() for optie in opties]
+        if not all(opties) or len(set(opties)) != 4:
+            return None
+        
+        correct = str(data.get("correct_antwoord") or "").strip()
+        if correct not in opties:
+            letter = correct.rstrip(").").upper()
+            matches = [optie for optie in opties if len(letter) == 1 and optie.upper().startswith(letter + ")")]
+            if len(matches) != 1:
+                return None
+            correct = matches[0]
+        
+        return cls(vraag, opties, correct, uitleg)
+    
+    def to_dict(self) -> dict:
+        return {"vraag": self.vraag, "opties": self.opties, "correct_antwoord": self.correct_antwoord, "uitleg": self.uitleg}
+
+
+class Flashcard:
+    """✅ Gevalideerde flashcard: een niet-lege term en definitie."""
+    
+    __slots__ = ("term", "definitie")
+    
+    LIST_KEY = "flashcards"
+    SCHEMA = {
+        "type": "object",
+        "properties": {
+            "term": {"type": "string"},
+            "definitie": {"type": "string"}
+        },
+        "required": ["term", "definitie"],
+        "additionalProperties": False
+    }
+    
+    def __init__(self, term: str, definitie: str):
+        self.term = term
+        self.definitie = definitie
+    
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            return None
+        term = str(data.get("term") or "").strip()
+        definitie = str(data.get("definitie") or "").strip()
+        if not term or not definitie:
+            return None
+        return cls(term, definitie)
+    
+    def to_dict(self) -> dict:
+        return {"term": self.term, "definitie": self.definitie}
+
+
+# Record-type per generatiemodus
+RECORD_TYPES = {"exam": ExamQuestion, "flashcards": Flashcard}
+
+
+def build_response_format(name: str, record_type) -> dict:
+    """Strikt structured-output schema: een object met één lijst records onder LIST_KEY."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {record_type.LIST_KEY: {"type": "array", "items": record_type.SCHEMA}},
+                "required": [record_type.LIST_KEY],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+RESPONSE_FORMATS = {mode: build_response_format(mode, record_type) for mode, record_type in RECORD_TYPES.items()}
+
+
+def is_complete_json(text: str) -> bool:
+    """True als de tekst geldige JSON is (een afgekapte response is dat niet)."""
+    try:
+        json.loads(text, strict=False)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_structured_items(response_text: str, record_type) -> list:
+    """
+    De ruwe item-lijst uit een gestructureerde response.
+    Het schema garandeert de vorm, dus normaal is dit één json.loads zonder sleutels te zoeken;
+    de tolerante parser is de terugvaloptie (json_object modus, afgekapte of kapotte output).
+    Gooit een exception als er niets bruikbaars in de response staat.
+    """
+    try:
+        return json.loads(response_text)[record_type.LIST_KEY]
+    except (ValueError, KeyError, TypeError):
+        return parse_json_items(response_text)
+
+
+def validate_records(items: list, record_type) -> tuple:
+    """Zet ruwe items om naar gevalideerde records: (records, aantal afgekeurd)."""
+    records = [record for record in map(record_type.from_dict, items) if record is not None]
+    return records, len(items) - len(records)
+
+
+def parse_records(response_text: str, record_type) -> tuple:
+    """Parse een gestructureerde response naar gevalideerde records: (records, aantal afgekeurd)."""
+    return validate_records(parse_structured_items(response_text, record_type), record_type)
+
+
+def is_cacheable_response(content: str, json_mode: bool, mode: str) -> bool:
+    """
+    🗄️ Alleen bruikbare responses horen in de cache: een afgekapte of ongeldige
+    JSON-response zou anders bij elke volgende aanroep opnieuw terugkomen.
+    """
+    if not content:
+        return False
+    if not json_mode:
+        return True
+    if not is_complete_json(content):
+        return False
+    record_type = RECORD_TYPES.get(mode)
+    if record_type is None:
+        return True
+    try:
+        records, rejected = parse_records(content, record_type)
+    except Exception:
+        return False
+    return bool(records) and rejected == 0
+
+
+class SystemPrompt:
+    """
+    Gerenderde system prompt. De prefix (rol, vak, boek, vraagtype en technische
+    instructies) is byte-identiek voor alle aanroepen met dezelfde studie/vak/boek;
+    de suffix bevat de modus-specifieke opdracht.
+    """
+    
+    __slots__ = ("prefix", "suffix", "text")
+    
+    def __init__(self, prefix: str, suffix: str):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.text = prefix + suffix
+
+
+class PromptCache:
+    """Begrensde LRU memo van gerenderde system prompts, gedeeld door alle sessies en threads."""
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get_or_build(self, key: tuple, build) -> SystemPrompt:
+        with self._lock:
+            prompt = self._entries.get(key)
+            if prompt is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return prompt
+            self.misses += 1
+        
+        prompt = build()
+        with self._lock:
+            self._entries[key] = prompt
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prompt
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+@st.cache_resource
+def get_prompt_cache() -> PromptCache:
+    return PromptCache(PROMPT_CACHE_MAX_ENTRIES)
+
+
+# Eén cache_resource lookup per rerun; daarna kost een prompt ophalen alleen een dict lookup
+PROMPT_CACHE = get_prompt_cache()
+
+
+def get_system_prompt(study: str, subject: str, book: str = None, mode: str = "practice", num_questions: int = 5, question_type: str = "Mix") -> SystemPrompt:
+    """
+    ⚡ Gememoiseerde system prompt: één keer gerenderd per
+    (studie, vak, boek, modus, aantal vragen, vraagtype) en daarna uit de cache.
+    """
+    key = (study, subject, book, mode, num_questions, question_type) if mode == "exam" else (study, subject, book, mode)
+    return PROMPT_CACHE.get_or_build(
+        key, lambda: build_system_prompt(study, subject, book, mode, num_questions, question_type)
+    )
+
+
+def construct_system_prompt(study: str, subject: str, book: str = None, mode: str = "practice", num_questions: int = 5, question_type: str = "Mix") -> str:
+    """🧠 SLIMME System Prompt Generator met BOEK-INTEGRATIE en GENEESKUNDE SPECIALISATIE."""
+    return get_system_prompt(study, subject, book, mode, num_questions, question_type).text
+
+
+def build_system_prompt(study: str, subject: str, book: str = None, mode: str = "practice", num_questions: int = 5, question_type: str = "Mix") -> SystemPrompt:
+    """Render de system prompt (zonder cache) als vaste prefix + modus-specifieke suffix."""
+    field_config = STUDY_FIELDS[study]
+    
+    base_instruction = f"""Je bent een gespecialiseerde AI-trainer voor {study}, maar je bent SPECIFIEK GESPECIALISEERD in {subject}.
+
+🎯 CRUCIALE INSTRUCTIE:
+Je bent niet alleen expert in {study}, je bent GESPECIALISEERD in {subject}. 
+Al je vragen en voorbeelden MOETEN specifiek over {subject} gaan. 
+Wijk hier NIET vanaf. Blijf binnen de grenzen van {subject}."""
+    
+    book_instruction = ""
+    if book and book != "Geen specifiek boek / Algemeen":
+        book_instruction = f"""
+
+📚 BOEK-SPECIFIEKE INSTRUCTIE (ZEER BELANGRIJK):
+Baseer je uitleg, structuur en terminologie SPECIFIEK op het boek: '{book}'.
+- Gebruik de definities zoals '{book}' ze hanteert
+- Volg de structuur en opbouw van '{book}'
+- Verwijs naar concepten zoals ze in '{book}' worden uitgelegd
+- Gebruik de terminologie en notatie van '{book}'
+Dit boek is de LEIDENDE bron voor je uitleg en vragen."""
+    
+    if mode == "practice":
+        prefix = f"""{base_instruction}{book_instruction}
+
+{field_config['role_instruction']}
+
+TECHNISCHE INSTRUCTIES:
+{field_config['tech_instruction']}
+
+"""
+        suffix = f"""WORKFLOW:
+1. Analyseer de brontekst/afbeelding grondig (of gebruik je kennis van {subject} als er geen bron is)
+2. Stel ÉÉN gerichte vraag SPECIFIEK over {subject}
+3. Wacht op het antwoord van de student
+4. Geef feedback:
+   - Begin met ✅ (correct) of ❌ (fout)
+   - Leg uit waarom het antwoord juist/onjuist is
+   - Geef aanvullende context BINNEN {subject}
+5. Stel een nieuwe, verdiepende vraag over {subject}
+
+BELANGRIJK:
+- Stel telkens maar ÉÉN vraag
+- Houd de vragen STRIKT gericht op {subject}
+- Bouw voort op eerdere antwoorden
+- Pas je niveau aan op basis van de antwoorden
+- Begin ALTIJD feedback met ✅ of ❌ voor score tracking
+"""
+    
+    elif mode == "exam":
+        # 🏥 FIX 3: GENEESKUNDE SPECIFIEK - Vraagtype instructie
+        question_type_instruction = ""
+        if study == "Geneeskunde 🩺":
+            if question_type == "Klinisch (Casussen)":
+                question_type_instruction = """
+
+🏥 VRAAGTYPE: KLINISCH (CASUSSEN)
+FOCUS op klinische casuïstiek:
+- Presenteer patiëntcasussen met symptomen
+- Vraag naar diagnoses, differentiaaldiagnoses
+- Test klinisch redeneren en besluitvorming
+- Gebruik realistische patiëntscenario's
+- Vraag naar behandelingsopties en prognose
+
+Voorbeeld structuur:
+"Een 45-jarige man presenteert zich met [symptomen]. Wat is de meest waarschijnlijke diagnose?"
+"""
+            elif question_type == "Theoretisch (Feiten)":
+                question_type_instruction = """
+
+📚 VRAAGTYPE: THEORETISCH (FEITEN)
+FOCUS op feitelijke kennis:
+- Vraag naar definities en mechanismen
+- Test kennis van anatomie, fysiologie, pathofysiologie
+- Vraag naar oorzaak-gevolg relaties
+- Test kennis van medicijnen en hun werkingsmechanismen
+- Geen casussen, alleen directe kennisvragen
+
+Voorbeeld structuur:
+"Wat is het werkingsmechanisme van [medicijn]?"
+"Welke structuur is verantwoordelijk voor [functie]?"
+"""
+            else:  # Mix
+                question_type_instruction = """
+
+🔀 VRAAGTYPE: MIX
+Combineer klinische casussen met theoretische vragen.
+- Ongeveer 50% casussen, 50% feitenvragen
+- Varieer de vraagstelling voor een compleet beeld
+"""
+        
+        # 🔧 BUG FIX 2: LaTeX escaping instructie voor JSON
+        latex_escape_instruction = ""
+        if study in ["Engineering & Wiskunde ⚙️", "Economie 📈"] or "Calculus" in subject or "Algebra" in subject:
+            latex_escape_instruction = """
+
+⚠️ CRUCIAAL VOOR JSON MET LaTeX:
+Wanneer je LaTeX formules gebruikt in je vragen of uitleg, moet je ELKE backslash DUBBEL escapen voor correcte JSON parsing.
 
 FOUT: "De afgeleide van $\\int x dx$ is..."
 GOED: "De afgeleide van $\\\\int x dx$ is..."
@@ -1192,14 +3300,15 @@ Voorbeelden van correcte escaping:
 Als je dit niet doet, crasht de JSON parsing en zien studenten rode vakjes of \\x0 karakters!
 """
         
-        system_prompt = f"""{base_instruction}{book_instruction}{question_type_instruction}{latex_escape_instruction}
+        prefix = f"""{base_instruction}{book_instruction}{question_type_instruction}{latex_escape_instruction}
 
 {field_config['role_instruction']}
 
 TECHNISCHE INSTRUCTIES:
 {field_config['tech_instruction']}
 
-OPDRACHT:
+"""
+        suffix = f"""OPDRACHT:
 Genereer EXACT {num_questions} multiple choice vragen SPECIFIEK over {subject}.
 
 OUTPUT FORMAT (STRICT JSON):
@@ -1225,14 +3334,15 @@ EISEN:
 """
     
     elif mode == "flashcards":
-        system_prompt = f"""{base_instruction}{book_instruction}
+        prefix = f"""{base_instruction}{book_instruction}
 
 {field_config['role_instruction']}
 
 TECHNISCHE INSTRUCTIES:
 {field_config['tech_instruction']}
 
-OPDRACHT:
+"""
+        suffix = f"""OPDRACHT:
 Genereer 10 flashcards met belangrijke begrippen/concepten SPECIFIEK uit {subject}.
 
 OUTPUT FORMAT (STRICT JSON):
@@ -1252,36 +3362,302 @@ EISEN:
 - Gebruik duidelijke, toegankelijke taal
 """
     
-    return system_prompt
+    return SystemPrompt(prefix, suffix)
+
+
+def build_cacheable_messages(system_prompt: SystemPrompt, subject: str, source_text: str) -> list:
+    """
+    ⚡ Berichtvolgorde voor provider-side prefix caching: eerst de vaste prompt-prefix,
+    dan het studiemateriaal, pas daarna de modus-specifieke opdracht (met bv. het aantal
+    vragen). Alles tot en met het studiemateriaal is byte-identiek over batches heen.
+    """
+    return [
+        {"role": "system", "content": system_prompt.prefix},
+        {"role": "user", "content": f"STUDIEMATERIAAL voor {subject}:\n\n{source_text}"},
+        {"role": "system", "content": system_prompt.suffix}
+    ]
+
+
+def select_model_route(mode: str, has_image: bool, prompt_tokens: int) -> dict:
+    """Kies het generatieprofiel uit MODEL_ROUTES voor deze modus en promptgrootte."""
+    routes = MODEL_ROUTES.get("vision" if has_image else mode) or MODEL_ROUTES["practice"]
+    for route in routes:
+        if prompt_tokens <= route.get("max_input_tokens", math.inf):
+            return route
+    return routes[-1]
+
+
+def build_completion_params(messages: list, has_image: bool = False, json_mode: bool = False, mode: str = "practice", max_tokens: int = None) -> dict:
+    """
+    Bouw de parameters voor een chat completion aanroep (model en limieten via MODEL_ROUTES).
+    Een opgegeven max_tokens (bv. van de batchplanner) overschrijft die van de route.
+    """
+    route = select_model_route(mode, has_image, estimate_prompt_tokens(messages))
+    
+    params = {
+        "model": route["model"],
+        "messages": messages,
+        "temperature": route["temperature"],
+        "max_tokens": max_tokens or route["max_tokens"]
+    }
+    
+    if json_mode:
+        # 🧱 Strikt schema voor tentamenvragen en flashcards, anders vrije JSON
+        response_format = RESPONSE_FORMATS.get(mode) if STRUCTURED_OUTPUTS_ENABLED else None
+        params["response_format"] = response_format or {"type": "json_object"}
+    
+    return params
+
+
+def run_completion_attempt(client: OpenAI, params: dict, session_id: str, timeout: float, cancel_token: CancelToken, mode: str, on_text=None, on_dispatch=None) -> tuple:
+    """
+    Eén poging voor een completion: (tekst, finish_reason, completion_tokens). Intern wordt gestreamd, zodat een
+    verliezende poging na het eerstvolgende chunk afgebroken en de verbinding gesloten kan worden.
+    🧾 Het laatste chunk bevat het tokengebruik (inclusief gecachete prompt tokens).
+    📡 on_text krijgt elk binnengekomen stuk tekst (bv. voor incrementeel parsen).
+    🚦 on_dispatch wordt aangeroepen zodra de scheduler het request doorlaat (ook bij een retry).
+    🏁 finish_reason "length" betekent dat de output op max_tokens is afgekapt; completion_tokens
+    komt uit het usage-chunk (None als de API dat niet meestuurt).
+    """
+    started = []
+    
+    def create_stream():
+        if cancel_token.cancelled:
+            raise CancelledError()
+        started.append(time.monotonic())
+        if on_dispatch is not None:
+            on_dispatch()
+        return client.with_options(timeout=timeout).chat.completions.create(
+            **params, stream=True, stream_options={"include_usage": True}
+        )
+    
+    scheduler = get_llm_scheduler()
+    stream = scheduler.run(session_id, estimate_request_tokens(params), create_stream, keep_slot=True, cancel_token=cancel_token)
+    try:
+        parts = []
+        finish_reason = None
+        completion_tokens = None
+        for chunk in stream:
+            if cancel_token.cancelled:
+                raise CancelledError()
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                if on_text is not None:
+                    on_text(chunk.choices[0].delta.content)
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.usage is not None:
+                completion_tokens = chunk.usage.completion_tokens
+                get_token_usage_stats().record(f"{mode}/{params['model']}", chunk.usage, time.monotonic() - started[-1])
+        return "".join(parts), finish_reason, completion_tokens
+    finally:
+        stream.close()
+        scheduler.release()
 
 
-def get_ai_response(client: OpenAI, messages: list, has_image: bool = False, json_mode: bool = False) -> str:
-    """Haal AI response op van OpenAI."""
+def run_hedged_completion(client: OpenAI, params: dict, mode: str, session_id: str, cancel_token: CancelToken = None, on_text=None) -> tuple:
+    """
+    ⏱️ Voer een completion uit binnen de deadline van de modus: (tekst, finish_reason, completion_tokens) van de winnende poging.
+    Duurt de eerste poging langer dan de p95 van deze modus (en is er hedge-budget),
+    dan gaat er een tweede poging uit; het eerste antwoord wint, de andere wordt afgebroken.
+    🛑 Wordt cancel_token geannuleerd, dan worden alle pogingen afgebroken (CancelledError).
+    📡 Met on_text wint de poging die als eerste tekst streamt: alleen die wordt
+    doorgegeven en de andere pogingen stoppen (de gebruiker ziet al resultaat).
+    🚦 Deadline, hedge-moment en gemeten latency lopen vanaf het moment dat de scheduler de
+    eerste poging doorlaat: wachten in de wachtrij telt niet mee.
+    """
+    tracker = get_latency_tracker()
+    executor = get_llm_attempt_executor()
+    deadline = LLM_DEADLINES.get(mode, OPENAI_TIMEOUT)
+    hedge_delay = tracker.hedge_delay(mode) if HEDGE_ENABLED else None
+    tracker.note_request()
+    
+    dispatched_at = []  # Moment waarop de scheduler de eerste poging doorliet
+    started = deadline_at = hedge_at = None
+    
+    def on_dispatch():
+        if not dispatched_at:
+            dispatched_at.append(time.monotonic())
+    
+    attempts_token = cancel_token.child() if cancel_token is not None else CancelToken()
+    streaming_owner = []
+    owner_lock = threading.Lock()
+    
+    def attempt_on_text(attempt: int):
+        if on_text is None:
+            return None
+        
+        def forward(text: str):
+            with owner_lock:
+                if not streaming_owner:
+                    streaming_owner.append(attempt)
+                is_owner = streaming_owner[0] == attempt
+            if not is_owner:
+                raise CancelledError()
+            on_text(text)
+        return forward
+    
+    primary = executor.submit(
+        run_completion_attempt, client, params, session_id, deadline, attempts_token, mode, attempt_on_text(0), on_dispatch
+    )
+    pending = {primary}
+    last_error = None
+    
     try:
-        model = "gpt-4o" if has_image else "gpt-4o"
+        while pending:
+            if deadline_at is None:
+                wake_at = time.monotonic() + GENERATION_POLL_SECONDS
+            else:
+                wake_at = deadline_at if hedge_at is None else min(hedge_at, deadline_at)
+                if cancel_token is not None:
+                    wake_at = min(wake_at, time.monotonic() + GENERATION_POLL_SECONDS)
+            done, pending = wait(pending, timeout=max(0.0, wake_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            
+            if cancel_token is not None and cancel_token.cancelled:
+                tracker.note_cancelled()
+                raise CancelledError()
+            
+            if started is None and dispatched_at:
+                started = dispatched_at[0]
+                deadline_at = started + deadline
+                hedge_at = started + hedge_delay if hedge_delay is not None and hedge_delay < deadline else None
+            
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as error:
+                    last_error = error
+                    continue
+                tracker.record(mode, time.monotonic() - started)
+                if future is not primary:
+                    tracker.note_hedge_win()
+                return result
+            
+            now = time.monotonic()
+            if pending and hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if not streaming_owner and tracker.try_reserve_hedge():
+                    pending.add(executor.submit(
+                        run_completion_attempt, client, params, session_id, deadline_at - now, attempts_token, mode,
+                        attempt_on_text(1)
+                    ))
+            elif pending and deadline_at is not None and now >= deadline_at:
+                tracker.record(mode, deadline)
+                tracker.note_deadline_exceeded()
+                raise TimeoutError(f"geen antwoord binnen de deadline van {deadline:.0f}s")
         
-        params = {
-            "model": model,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 3000
-        }
+        raise last_error
+    finally:
+        # Breek de verliezende (of te late) pogingen af
+        attempts_token.cancel()
+
+
+def response_cache_can_serve(messages: list, mode: str, cache_namespace: str, max_tokens: int = None) -> bool:
+    """Zou een JSON-aanroep van get_ai_response met deze berichten nu uit de cache komen?"""
+    params = build_completion_params(messages, False, True, mode, max_tokens)
+    return get_response_cache().can_serve(ResponseCache.make_key(params, cache_namespace))
+
+
+def get_ai_response(client: OpenAI, messages: list, has_image: bool = False, json_mode: bool = False, cache_namespace: str = None, session_id: str = None, mode: str = "practice", cancel_token: CancelToken = None, on_text=None, max_tokens: int = None, on_finish=None) -> str:
+    """
+    Haal AI response op van OpenAI.
+    🗄️ Met een cache_namespace wordt de response gecachet op model, parameters en berichten,
+       maar alleen als hij bruikbaar is (zie is_cacheable_response).
+    🚦 Elke aanroep loopt via de globale scheduler; achtergrondwerk geeft zijn session_id mee.
+    ⏱️ De aanroep heeft een deadline per modus en wordt zo nodig gehedged (zie run_hedged_completion).
+    🛑 Een geannuleerd cancel_token breekt de aanroep af met CancelledError.
+    📡 on_text krijgt de tekst terwijl die binnenstroomt (niet bij een cache hit).
+    🏁 on_finish krijgt (finish_reason, completion_tokens) van de completion (niet bij een cache hit).
+    """
+    try:
+        params = build_completion_params(messages, has_image, json_mode, mode, max_tokens)
+        
+        cache_key = None
+        if cache_namespace is not None:
+            response_cache = get_response_cache()
+            cache_key = ResponseCache.make_key(params, cache_namespace)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        content, finish_reason, completion_tokens = run_hedged_completion(client, params, mode, session_id or current_session_id(), cancel_token, on_text)
+        content = content.strip()
+        if on_finish is not None:
+            on_finish(finish_reason, completion_tokens)
         
-        if json_mode:
-            params["response_format"] = {"type": "json_object"}
+        if cache_key is not None and finish_reason != "length" and is_cacheable_response(content, json_mode, mode):
+            response_cache.put(cache_key, content)
+        return content
+    
+    except CancelledError:
+        raise
+    except Exception as e:
+        return f"{AI_ERROR_PREFIX}: {str(e)}"
+
+
+def stream_ai_response(client: OpenAI, messages: list, has_image: bool = False, session_id: str = None, mode: str = "practice"):
+    """
+    ⚡ STREAMING VARIANT van get_ai_response.
+    Yield de tekst-deltas zodra ze binnenkomen, zodat de student niet op de
+    volledige completion hoeft te wachten.
+    ⏱️ Wel een deadline, geen hedging: de student leest de eerste tokens al mee.
+    """
+    try:
+        params = build_completion_params(messages, has_image, mode=mode)
+        params["stream"] = True
+        params["stream_options"] = {"include_usage": True}
+        deadline = LLM_DEADLINES.get(mode, OPENAI_TIMEOUT)
         
-        response = client.chat.completions.create(**params)
-        return response.choices[0].message.content.strip()
+        # 🚦 De scheduler-slot blijft bezet zolang de stream loopt; de deadline loopt vanaf de dispatch
+        scheduler = get_llm_scheduler()
+        stream = scheduler.run(
+            session_id or current_session_id(),
+            estimate_request_tokens(params),
+            lambda: client.with_options(timeout=deadline).chat.completions.create(**params),
+            keep_slot=True
+        )
+        started = time.monotonic()
+        deadline_at = started + deadline
+        try:
+            for chunk in stream:
+                if time.monotonic() > deadline_at:
+                    get_latency_tracker().note_deadline_exceeded()
+                    yield f"\n\n{AI_ERROR_PREFIX}: geen volledig antwoord binnen de deadline van {deadline:.0f}s"
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage is not None:
+                    get_token_usage_stats().record(f"{mode}/{params['model']}", chunk.usage, time.monotonic() - started)
+        finally:
+            stream.close()
+            scheduler.release()
     
     except Exception as e:
-        return f"❌ Fout bij AI aanroep: {str(e)}"
+        yield f"{AI_ERROR_PREFIX}: {str(e)}"
+
+
+def detect_score_marker(text: str):
+    """Geef de score-marker (✅ of ❌) terug waarmee de feedback begint, anders None."""
+    stripped = text.lstrip()
+    if stripped.startswith(AI_ERROR_PREFIX):
+        return None
+    for marker in ("✅", "❌"):
+        if stripped.startswith(marker):
+            return marker
+    return None
 
 
 def reset_session():
     """Reset de sessie."""
+    cancel_generation()
     st.session_state.history = []
+    st.session_state.history_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_job = None
+    st.session_state.speculative_question = None
     st.session_state.context_set = False
     st.session_state.source_text = ""
+    st.session_state.source_hash = None
     st.session_state.image_base64 = None
     st.session_state.file_type = None
     st.session_state.score = 0
@@ -1294,10 +3670,201 @@ def reset_session():
     st.session_state.show_flashcard_answer = False
 
 
+# ============================================================================
+# 🔮 ACHTERGROND-PREFETCH VAN TENTAMEN-BATCHES EN FLASHCARD DECKS
+# ============================================================================
+
+class QuestionPrefetcher:
+    """
+    Per sessie een kleine voorraad kant-en-klare batches (lijsten met items) voor
+    één selectie-sleutel. Een andere sleutel of invalidate() gooit de voorraad weg.
+    🛑 Alle prefetches van de voorraad delen cancel_token; invalidate() annuleert het,
+    zodat ook aanroepen die al lopen stoppen.
+    """
+    
+    def __init__(self):
+        self.key = None
+        self.ready = []    # Lijsten met items
+        self.pending = []  # Futures die een lijst met items (of None) opleveren
+        self.cancel_token = CancelToken()
+        self._lock = threading.Lock()
+    
+    def invalidate(self):
+        """Gooi de voorraad weg (bv. bij een andere studie of een ander jaar)."""
+        with self._lock:
+            self.cancel_token.cancel()
+            self.cancel_token = CancelToken()
+            for future in self.pending:
+                future.cancel()
+            self.key = None
+            self.ready = []
+            self.pending = []
+    
+    def _collect(self):
+        still_pending = []
+        for future in self.pending:
+            if not future.done():
+                still_pending.append(future)
+            elif not future.cancelled() and future.exception() is None and future.result():
+                self.ready.append(future.result())
+        self.pending = still_pending
+    
+    def refill_count(self, key: tuple, target: int) -> int:
+        """Hoeveel nieuwe batches er gestart moeten worden voor deze sleutel."""
+        if key != self.key:
+            self.invalidate()
+        with self._lock:
+            self.key = key
+            self._collect()
+            stock = len(self.ready) + len(self.pending)
+            return target - stock if stock < PREFETCH_LOW_WATERMARK else 0
+    
+    def add_pending(self, future):
+        with self._lock:
+            self.pending.append(future)
+    
+    def take(self, key: tuple, max_items: int, cancel_token: CancelToken = None) -> list:
+        """
+        Haal maximaal max_items items uit de voorraad. Lopende prefetches worden
+        afgewacht in plaats van dubbel gegenereerd; een restant gaat terug in de voorraad.
+        🛑 Tijdens het wachten wordt cancel_token gecontroleerd (CancelledError).
+        """
+        items = []
+        while len(items) < max_items:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise CancelledError()
+            with self._lock:
+                if key != self.key:
+                    break
+                self._collect()
+                if self.ready:
+                    batch = self.ready.pop(0)
+                    needed = max_items - len(items)
+                    items.extend(batch[:needed])
+                    if len(batch) > needed:
+                        self.ready.insert(0, batch[needed:])
+                    continue
+                pending = list(self.pending)
+            if not pending:
+                break
+            wait(pending, timeout=GENERATION_POLL_SECONDS, return_when=FIRST_COMPLETED)
+        return items
+
+
+def fetch_generated_items(client: OpenAI, messages: list, session_id: str = None, mode: str = "exam", cancel_token: CancelToken = None):
+    """Achtergrond-worker: genereer en parse één batch. Geeft None bij een fout."""
+    response = get_ai_response(
+        client, messages, has_image=False, json_mode=True,
+        session_id=session_id, mode=mode, cancel_token=cancel_token
+    )
+    try:
+        records = parse_records(response, RECORD_TYPES[mode])[0]
+    except Exception:
+        return None
+    return [record.to_dict() for record in records]
+
+
+def warm_response_cache(client: OpenAI, messages: list, cache_namespace: str, max_tokens: int = None, session_id: str = None, mode: str = "exam", cancel_token: CancelToken = None):
+    """Achtergrond-worker: doe een gecachete aanroep van de job alvast. Levert geen voorraad op (None)."""
+    get_ai_response(
+        client, messages, has_image=False, json_mode=True, cache_namespace=cache_namespace,
+        session_id=session_id, mode=mode, cancel_token=cancel_token, max_tokens=max_tokens
+    )
+    return None
+
+
+def get_prefetch_key(kind: str, study: str, subject: str, book: str, question_type: str = "") -> tuple:
+    """Selectie-sleutel van de prefetch-voorraad."""
+    return (kind, study, st.session_state.selected_year, subject, book, question_type, st.session_state.source_hash)
+
+
+def plan_prefetch_requests(kind: str, study: str, subject: str, book: str, question_type: str, source_context: str) -> list:
+    """
+    De aanroepen die de prefetch voor deze selectie doet: [(berichten, cache_namespace, max_tokens)].
+    🗄️ Zonder bestand zijn dat precies de gecachete aanroepen die de job zelf zou doen
+    (zelfde tekort na de vragenbank, zelfde batchplan, zelfde namespaces); met een bestand
+    nieuwe, ongecachete batches voor de voorraad.
+    """
+    bank_filters = get_bank_filters(study, subject, book, question_type)
+    if kind == "flashcards":
+        messages = build_flashcard_messages(study, subject, book, source_context)
+        if source_context:
+            return [(messages, None, None)] * PREFETCH_FLASHCARD_DECKS
+        if len(take_from_bank("flashcard", bank_filters, FLASHCARDS_PER_DECK)) >= FLASHCARDS_PER_DECK:
+            return []
+        return [(messages, "flashcards", None)]
+    if source_context:
+        messages = build_exam_batch_messages(study, subject, book, EXAM_BATCH_SIZE, source_context, question_type)
+        return [(messages, None, None)] * PREFETCH_EXAM_BATCHES
+    num_questions = st.session_state.exam_num_questions
+    shortfall = num_questions - len(take_from_bank("exam", bank_filters, num_questions))
+    if shortfall <= 0:
+        return []
+    plan = plan_exam_batches(study, subject, book, shortfall, None, question_type, record=False)
+    return [
+        (build_exam_batch_messages(study, subject, book, size, None, question_type), f"exam-batch-{batch_index}", plan.max_tokens)
+        for batch_index, size in enumerate(plan.batch_sizes)
+    ]
+
+
+def prefetch_generation(client: OpenAI, study: str, subject: str, book: str):
+    """
+    🔮 Houd de voorraad voor de huidige selectie op peil, zodat "Genereer Tentamen"
+    en "Maak Flashcards" in het gewone geval direct klaar zijn.
+    🗄️ Zonder bestand vult de prefetch alleen de response cache met de aanroepen van de job
+    (de job wacht in take() op lopende prefetches en leest daarna de cache); kan de cache
+    die al beantwoorden, dan is er niets te prefetchen.
+    """
+    if not PREFETCH_ENABLED or st.session_state.context_set or st.session_state.file_type == "image":
+        return
+    
+    if st.session_state.study_mode == "📝 Tentamen Simulatie":
+        kind, question_type = "exam", st.session_state.exam_question_type
+    elif st.session_state.study_mode == "🃏 Flashcards":
+        kind, question_type = "flashcards", ""
+    else:
+        return
+    
+    source_context = select_source_context(build_retrieval_query(subject, book)) if st.session_state.source_text else None
+    requests = [
+        (messages, cache_namespace, max_tokens)
+        for messages, cache_namespace, max_tokens in plan_prefetch_requests(kind, study, subject, book, question_type, source_context)
+        if cache_namespace is None or not response_cache_can_serve(messages, kind, cache_namespace, max_tokens)
+    ]
+    if not requests:
+        return
+    
+    prefetcher = st.session_state.prefetcher
+    missing = prefetcher.refill_count(get_prefetch_key(kind, study, subject, book, question_type), len(requests))
+    if missing <= 0:
+        return
+    
+    executor = get_background_executor()
+    session_id = current_session_id()
+    for messages, cache_namespace, max_tokens in requests[:missing]:
+        if cache_namespace is None:
+            future = executor.submit(fetch_generated_items, client, messages, session_id, kind, prefetcher.cancel_token)
+        else:
+            future = executor.submit(
+                warm_response_cache, client, messages, cache_namespace, max_tokens, session_id, kind, prefetcher.cancel_token
+            )
+        prefetcher.add_pending(future)
+
+
 # ============================================================================
 # 🟢 OEFENMODUS FUNCTIES
 # ============================================================================
 
+def stream_practice_reply(client: OpenAI, messages: list, has_image: bool = False) -> str:
+    """Toon het AI antwoord token-voor-token in een chat bubble en geef de volledige tekst terug."""
+    with st.chat_message("assistant", avatar="🤖"):
+        reply = st.write_stream(stream_ai_response(client, messages, has_image))
+    
+    if not isinstance(reply, str):
+        reply = "".join(str(part) for part in reply)
+    return reply.strip()
+
+
 def start_practice_mode(client: OpenAI, study: str, subject: str, book: str, with_file: bool = True):
     """Start oefenmodus."""
     if with_file:
@@ -1318,9 +3885,10 @@ def start_practice_mode(client: OpenAI, study: str, subject: str, book: str, wit
             messages.append({"role": "user", "content": user_content})
             has_image = True
         else:
+            source_context = select_source_context(build_retrieval_query(subject, book))
             user_content = f"""STUDIEMATERIAAL voor {subject}:
 
-{st.session_state.source_text}
+{source_context}
 
 Analyseer dit materiaal en stel je eerste vraag SPECIFIEK over {subject}."""
             messages.append({"role": "user", "content": user_content})
@@ -1354,8 +3922,7 @@ Begin nu met je eerste vraag over {subject}."""
         has_image = False
         st.session_state.file_type = "no_file"
     
-    with st.spinner("🤖 AI bereidt de eerste vraag voor..."):
-        first_question = get_ai_response(client, messages, has_image)
+    first_question = stream_practice_reply(client, messages, has_image)
     
     if first_question.startswith("❌"):
         st.error(first_question)
@@ -1369,16 +3936,83 @@ Begin nu met je eerste vraag over {subject}."""
     st.rerun()
 
 
-def handle_practice_answer(client: OpenAI, user_answer: str, study: str, subject: str, book: str):
-    """Verwerk antwoord in oefenmodus."""
-    if not user_answer.strip():
-        return
+def summarize_practice_turns(client: OpenAI, subject: str, previous_summary: str, turns: list, session_id: str, cancel_token: CancelToken) -> str:
+    """
+    Vouw oudere oefenbeurten samen met de bestaande samenvatting tot één korte samenvatting.
+    Draait in een achtergrond thread: gebruikt geen Streamlit API's.
+    """
+    transcript = "\n\n".join(
+        f"{'STUDENT' if msg['role'] == 'user' else 'TRAINER'}: {msg['content']}" for msg in turns
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": f"""Je vat een oefensessie over {subject} samen voor een AI-trainer.
+Noem beknopt (max 150 woorden):
+- Welke onderwerpen en vragen al behandeld zijn
+- Wat de student goed beheerste en waar fouten/misvattingen zaten
+Geen scores herhalen, geen nieuwe vragen stellen."""
+        },
+        {
+            "role": "user",
+            "content": f"""BESTAANDE SAMENVATTING:
+{previous_summary or "(nog geen)"}
+
+NIEUWE BEURTEN:
+{transcript}
+
+Geef de bijgewerkte samenvatting."""
+        }
+    ]
+    return get_ai_response(client, messages, session_id=session_id, mode="summary", cancel_token=cancel_token)
+
+
+def build_practice_history_messages(client: OpenAI, subject: str) -> list:
+    """
+    🗜️ GESPREKSCOMPACTIE
+    Geef de geschiedenis voor de prompt terug: een rolling samenvatting van oudere
+    beurten plus de recente berichten letterlijk. Het samenvatten gebeurt op de
+    achtergrond en wordt bij een volgende beurt toegepast, zodat de promptgrootte
+    begrensd blijft zonder extra wachttijd. Score bookkeeping blijft ongewijzigd.
+    """
+    history = st.session_state.history
     
-    st.session_state.history.append({
-        "role": "user",
-        "content": user_answer
-    })
+    # Pas een afgeronde samenvatting toe
+    summary_job = st.session_state.summary_job
+    if summary_job is not None and summary_job["future"].done():
+        st.session_state.summary_job = None
+        new_summary = summary_job["future"].result()
+        if new_summary and not new_summary.startswith(AI_ERROR_PREFIX) and summary_job["upto"] <= len(history):
+            st.session_state.history_summary = new_summary
+            st.session_state.summarized_count = summary_job["upto"]
+    
+    # Start een nieuwe samenvatting als er genoeg oude beurten buiten het venster vallen
+    fold_upto = len(history) - PRACTICE_HISTORY_KEEP_TURNS * 2
+    pending = fold_upto - st.session_state.summarized_count
+    if st.session_state.summary_job is None and pending >= PRACTICE_SUMMARY_BATCH_TURNS * 2:
+        future = get_background_executor().submit(
+            summarize_practice_turns,
+            client,
+            subject,
+            st.session_state.history_summary,
+            list(history[st.session_state.summarized_count:fold_upto]),
+            current_session_id(),
+            st.session_state.generation_token
+        )
+        st.session_state.summary_job = {"future": future, "upto": fold_upto}
     
+    messages = []
+    if st.session_state.history_summary:
+        messages.append({
+            "role": "system",
+            "content": f"SAMENVATTING VAN HET EERDERE GESPREK (scores zijn al verwerkt):\n{st.session_state.history_summary}"
+        })
+    messages.extend(history[st.session_state.summarized_count:])
+    return messages
+
+
+def build_practice_messages(client: OpenAI, study: str, subject: str, book: str, retrieval_query: str) -> tuple:
+    """Bouw system prompt, studiemateriaal en (gecompacte) geschiedenis voor een oefenbeurt."""
     system_prompt = construct_system_prompt(study, subject, book, "practice")
     messages = [{"role": "system", "content": system_prompt}]
     
@@ -1391,9 +4025,19 @@ def handle_practice_answer(client: OpenAI, user_answer: str, study: str, subject
         messages.append({"role": "user", "content": initial_content})
         has_image = True
     elif st.session_state.file_type == "pdf" and st.session_state.source_text:
-        initial_content = f"STUDIEMATERIAAL voor {subject}:\n\n{st.session_state.source_text}"
-        messages.append({"role": "user", "content": initial_content})
+        # 🔎 Alleen de chunks die passen bij de huidige vraag (en het antwoord van de student)
+        source_context = select_source_context(retrieval_query)
+        initial_content = f"STUDIEMATERIAAL voor {subject}:\n\n{source_context}"
         has_image = False
+        if source_context != st.session_state.source_text:
+            # ⚡ Per beurt wisselende chunks komen vlak voor de laatste beurt, zodat
+            # system prompt + eerdere beurten een stabiele prefix voor de provider-cache blijven
+            history_messages = build_practice_history_messages(client, subject)
+            messages.extend(history_messages[:-1])
+            messages.append({"role": "system", "content": f"RELEVANT {initial_content}"})
+            messages.extend(history_messages[-1:])
+            return messages, has_image
+        messages.append({"role": "user", "content": initial_content})
     elif st.session_state.file_type == "no_file":
         initial_content = f"Je bent expert in {subject}. Gebruik je kennis om vragen te stellen en feedback te geven."
         messages.append({"role": "user", "content": initial_content})
@@ -1401,18 +4045,95 @@ def handle_practice_answer(client: OpenAI, user_answer: str, study: str, subject
     else:
         has_image = False
     
-    for msg in st.session_state.history:
-        messages.append(msg)
+    # 🗜️ Samenvatting + laatste beurten in plaats van de volledige geschiedenis
+    messages.extend(build_practice_history_messages(client, subject))
+    return messages, has_image
+
+
+def start_speculative_question(client: OpenAI, study: str, subject: str, book: str):
+    """
+    ⚡ SPECULATIEF OEFENEN
+    Terwijl de student over zijn antwoord nadenkt, wordt op de achtergrond alvast
+    de volgende vraag gegenereerd. Bij het antwoord hoeft de AI dan alleen nog
+    feedback te geven. Het resultaat staat in session_state, gekoppeld aan de beurt.
+    """
+    history = st.session_state.history
+    if not history or history[-1]["role"] != "assistant":
+        return
+    
+    speculative = st.session_state.speculative_question
+    if speculative is not None and speculative["turn"] == len(history):
+        return  # Al gestart voor deze beurt
+    
+    messages, has_image = build_practice_messages(client, study, subject, book, f"{subject} {history[-1]['content']}")
+    messages.append({
+        "role": "system",
+        "content": f"""Bereid alvast je VOLGENDE vraag voor, alsof de student je laatste vraag net beantwoord heeft.
+- Kies een ander aspect van {subject} dan je laatste vraag, of verdiep het onderwerp
+- Geef ALLEEN de nieuwe vraag: geen feedback, geen ✅ of ❌, geen inleiding"""
+    })
+    
+    future = get_background_executor().submit(
+        get_ai_response, client, messages, has_image,
+        session_id=current_session_id(), cancel_token=st.session_state.generation_token
+    )
+    st.session_state.speculative_question = {"turn": len(history), "future": future}
+
+
+def handle_practice_answer(client: OpenAI, user_answer: str, study: str, subject: str, book: str):
+    """Verwerk antwoord in oefenmodus."""
+    if not user_answer.strip():
+        return
+    
+    # ⚡ Een speculatief voorbereide vervolgvraag voor precies deze beurt
+    speculative = st.session_state.speculative_question
+    st.session_state.speculative_question = None
+    if speculative is not None and speculative["turn"] != len(st.session_state.history):
+        speculative = None
+    
+    last_question = next(
+        (msg["content"] for msg in reversed(st.session_state.history) if msg["role"] == "assistant"),
+        ""
+    )
+    
+    st.session_state.history.append({
+        "role": "user",
+        "content": user_answer
+    })
+    
+    messages, has_image = build_practice_messages(client, study, subject, book, f"{subject} {last_question} {user_answer}")
+    
+    if speculative is not None:
+        messages.append({
+            "role": "system",
+            "content": "Geef nu ALLEEN feedback op dit antwoord (begin met ✅ of ❌). Stel GEEN nieuwe vraag; die volgt apart."
+        })
+    
+    with st.chat_message("user", avatar="👤"):
+        st.markdown(user_answer)
     
-    with st.spinner("🤔 AI analyseert je antwoord..."):
-        feedback = get_ai_response(client, messages, has_image)
+    # ⚡ Stream de feedback; de score-marker staat in de eerste tokens
+    feedback = stream_practice_reply(client, messages, has_image)
     
-    if feedback.strip().startswith("✅"):
+    marker = detect_score_marker(feedback)
+    if marker == "✅":
         st.session_state.score += 1
         st.session_state.total_questions += 1
-    elif feedback.strip().startswith("❌"):
+    elif marker == "❌":
         st.session_state.total_questions += 1
     
+    if speculative is not None and not feedback.startswith(AI_ERROR_PREFIX):
+        next_question = speculative["future"].result()
+        if next_question.startswith(AI_ERROR_PREFIX):
+            # Speculatie mislukt: vraag de vervolgvraag alsnog direct aan
+            messages.append({"role": "assistant", "content": feedback})
+            messages.append({"role": "system", "content": f"Stel nu je volgende vraag over {subject}."})
+            next_question = stream_practice_reply(client, messages, has_image)
+        else:
+            with st.chat_message("assistant", avatar="🤖"):
+                st.markdown(next_question)
+        feedback = f"{feedback}\n\n{next_question}"
+    
     st.session_state.history.append({
         "role": "assistant",
         "content": feedback
@@ -1423,24 +4144,21 @@ def handle_practice_answer(client: OpenAI, user_answer: str, study: str, subject
 # 📝 TENTAMENMODUS FUNCTIES - MET BATCHING LOGICA
 # ============================================================================
 
-def generate_exam_batch(client: OpenAI, study: str, subject: str, book: str, num_questions: int, source_text: str = None, question_type: str = "Mix"):
+def build_exam_batch_messages(study: str, subject: str, book: str, num_questions: int, source_text: str = None, question_type: str = "Mix") -> list:
     """
-    🔧 FIX 1: BATCHING LOGICA
-    Genereer een ENKELE batch van max 5 vragen.
-    Deze functie wordt meerdere keren aangeroepen door generate_exam_questions.
+    Bouw de berichten voor een ENKELE tentamen-batch (zonder AI aanroep).
+    ⚡ Met brontekst staan de grote, vaste delen vooraan (prompt-prefix, studiemateriaal),
+    zodat de provider-cache ze over alle batches van dezelfde bron hergebruikt.
     """
-    system_prompt = construct_system_prompt(study, subject, book, "exam", num_questions, question_type)
-    messages = [{"role": "system", "content": system_prompt}]
+    system_prompt = get_system_prompt(study, subject, book, "exam", num_questions, question_type)
     
     if source_text and source_text.strip():
         # MET BRONTEKST
-        user_content = f"""STUDIEMATERIAAL voor {subject}:
-
-{source_text}
-
-INSTRUCTIE: Gebruik ENKEL de brontekst voor de vragen.
+        messages = build_cacheable_messages(system_prompt, subject, source_text)
+        user_content = f"""INSTRUCTIE: Gebruik ENKEL de brontekst voor de vragen.
 Genereer nu EXACT {num_questions} multiple choice vragen SPECIFIEK over {subject} in JSON format."""
     else:
+        messages = [{"role": "system", "content": system_prompt.text}]
         # ZONDER BRONTEKST
         book_context = f" en de stijl van '{book}'" if book and book != "Geen specifiek boek / Algemeen" else ""
         user_content = f"""GEEN BRONTEKST BESCHIKBAAR.
@@ -1451,54 +4169,144 @@ Genereer representatieve, uitdagende vragen die een student van {subject} zou mo
 Genereer nu EXACT {num_questions} multiple choice vragen SPECIFIEK over {subject} in JSON format."""
     
     messages.append({"role": "user", "content": user_content})
-    
-    response = get_ai_response(client, messages, has_image=False, json_mode=True)
-    return clean_and_parse_json(response)
+    return messages
+
+
+def plan_exam_batches(study: str, subject: str, book: str, num_questions: int, source_text: str, question_type: str, record: bool = True) -> BatchPlan:
+    """Batchplan voor een tentamen; max_tokens is begrensd door de modelroute van de prompt."""
+    reference_messages = build_exam_batch_messages(study, subject, book, EXAM_BATCH_SIZE, source_text, question_type)
+    max_tokens_cap = select_model_route("exam", False, estimate_prompt_tokens(reference_messages))["max_tokens"]
+    return get_batch_planner().plan(study, question_type, num_questions, EXAM_MAX_CONCURRENCY, max_tokens_cap, record)
 
 
-def generate_exam_questions(client: OpenAI, study: str, subject: str, book: str, total_questions: int, source_text: str = None, question_type: str = "Mix"):
+def generate_exam_batches(client: OpenAI, study: str, subject: str, book: str, num_questions: int, source_text: str, question_type: str, job: GenerationJob, session_id: str, use_cache: bool, duplicate_index: NearDuplicateIndex) -> list:
     """
-    🔧 FIX 1: BATCHING LOGICA (HOOFDFUNCTIE)
-    Genereer tentamenvragen in batches van max 5 vragen.
-    Voorkomt dat de AI te veel vragen tegelijk genereert en crasht.
+    Vraag num_questions vragen parallel aan (max EXAM_MAX_CONCURRENCY batches tegelijk)
+    en geef de geldige, nieuwe vragen in batch-volgorde terug.
+    📐 Batchgroottes en max_tokens komen van de batchplanner, die ook de uitkomsten krijgt.
+    📡 Elke vraag gaat naar de job zodra zijn JSON object compleet binnen is gestreamd.
+    🧬 Bijna-duplicaten van vragen in duplicate_index (ook uit andere batches) vallen af.
     """
-    BATCH_SIZE = 5
-    num_batches = (total_questions + BATCH_SIZE - 1) // BATCH_SIZE  # Ceil division
+    planner = get_batch_planner()
+    plan = plan_exam_batches(study, subject, book, num_questions, source_text, question_type)
+    batch_sizes = plan.batch_sizes
+    num_batches = len(batch_sizes)
     
-    all_questions = []
+    batch_results = [[] for _ in range(num_batches)]
+    rejected_counts = [0] * num_batches
+    duplicate_counts = [0] * num_batches
+    parsers = [StreamingItemParser() for _ in range(num_batches)]
+    started_at = [None] * num_batches
+    first_text_at = [None] * num_batches
+    finish_reasons = [None] * num_batches
+    completion_tokens = [None] * num_batches
+    max_workers = min(EXAM_MAX_CONCURRENCY, num_batches) or 1
     
-    # Progress container
-    progress_container = st.empty()
-    progress_bar = st.progress(0)
+    def publish(batch_index: int, items: list):
+        """Valideer en ontdubbel (deel)resultaten van een batch en geef ze direct door aan de job."""
+        records, rejected = validate_records(items, ExamQuestion)
+        questions = duplicate_index.filter([record.to_dict() for record in records])
+        rejected_counts[batch_index] += rejected
+        duplicate_counts[batch_index] += len(records) - len(questions)
+        batch_results[batch_index].extend(questions)
+        job.add_items(questions)
     
-    for batch_num in range(num_batches):
-        # Bereken hoeveel vragen in deze batch
-        remaining = total_questions - len(all_questions)
-        questions_in_batch = min(BATCH_SIZE, remaining)
-        
-        # Update progress
-        progress_container.info(f"📝 Batch {batch_num + 1}/{num_batches} wordt gegenereerd ({questions_in_batch} vragen)...")
-        
-        # Genereer batch
-        batch_questions = generate_exam_batch(
-            client,
-            study,
-            subject,
-            book,
-            questions_in_batch,
-            source_text,
-            question_type
+    def stream_handler(batch_index: int, text: str):
+        if first_text_at[batch_index] is None:
+            first_text_at[batch_index] = time.monotonic()
+        publish(batch_index, parsers[batch_index].feed(text))
+    
+    def finish_handler(batch_index: int, finish_reason: str, output_tokens: int):
+        finish_reasons[batch_index] = finish_reason
+        completion_tokens[batch_index] = output_tokens
+    
+    def run_batch(batch_index: int, messages: list, cache_namespace: str) -> str:
+        started_at[batch_index] = time.monotonic()
+        return get_ai_response(
+            client, messages, False, True, cache_namespace, session_id, "exam", job.cancel_token,
+            lambda text: stream_handler(batch_index, text), plan.max_tokens,
+            lambda finish_reason, output_tokens: finish_handler(batch_index, finish_reason, output_tokens)
         )
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for batch_index, questions_in_batch in enumerate(batch_sizes):
+            messages = build_exam_batch_messages(study, subject, book, questions_in_batch, source_text, question_type)
+            cache_namespace = f"exam-batch-{batch_index}" if use_cache else None
+            futures[executor.submit(run_batch, batch_index, messages, cache_namespace)] = batch_index
         
+        for future in as_completed(futures):
+            batch_index = futures[future]
+            # Wat niet al gestreamd is (cache hit, of alleen te redden uit de volledige tekst) komt er nu bij
+            response = None
+            try:
+                response = future.result()
+                items = parse_structured_items(response, ExamQuestion)
+            except CancelledError:
+                raise
+            except Exception as e:
+                if not parsers[batch_index].items_seen:
+                    job.warn(f"❌ Fout bij JSON parsing: {str(e)}", "error")
+                items = []
+            publish(batch_index, items[parsers[batch_index].items_seen:])
+            
+            if response is not None and not response.startswith(AI_ERROR_PREFIX):
+                started = started_at[batch_index]
+                first_text = first_text_at[batch_index]
+                received = max(len(items), parsers[batch_index].items_seen)
+                # Echte completion_tokens uit de usage; bij een cache hit (of zonder usage) een schatting
+                output_tokens = completion_tokens[batch_index]
+                if output_tokens is None:
+                    output_tokens = len(response) / 4
+                planner.observe(
+                    study, question_type, batch_sizes[batch_index], received, output_tokens,
+                    truncated=finish_reasons[batch_index] == "length",
+                    seconds=time.monotonic() - started, ttft=None if first_text is None else first_text - started
+                )
+            
+            if rejected_counts[batch_index]:
+                job.warn(f"⚠️ {rejected_counts[batch_index]} ongeldige vragen overgeslagen.")
+            if duplicate_counts[batch_index]:
+                job.warn(f"🧬 {duplicate_counts[batch_index]} (bijna) dubbele vragen overgeslagen.", "info")
+    
+    # Voeg batches samen in een stabiele volgorde
+    questions = []
+    for batch_questions in batch_results:
         if batch_questions:
-            all_questions.extend(batch_questions)
-        
-        # Update progress bar
-        progress_bar.progress((batch_num + 1) / num_batches)
+            questions.extend(batch_questions)
+    return questions
+
+
+def generate_exam_questions(client: OpenAI, study: str, subject: str, book: str, total_questions: int, source_text: str, question_type: str, job: GenerationJob, session_id: str = None, duplicate_index: NearDuplicateIndex = None):
+    """
+    ⚡ PARALLELLE BATCHING LOGICA (HOOFDFUNCTIE)
+    Genereer tentamenvragen in batches; de batchplanner kiest per ronde de batchgroottes
+    (EXAM_MIN_BATCH_SIZE..EXAM_MAX_BATCH_SIZE) en max_tokens op basis van eerdere metingen.
+    Alle batches worden tegelijk aangevraagd (max EXAM_MAX_CONCURRENCY), zodat
+    een groot tentamen ongeveer net zo lang duurt als één enkele AI aanroep.
+    De volgorde van de vragen blijft gelijk aan de batch-volgorde.
+    🧵 Draait binnen een generatie-job: geen Streamlit API's, voortgang gaat via de job.
+    🩹 Afgekapte of licht kapotte batches worden gered en elke vraag wordt gevalideerd;
+    alleen het tekort wordt daarna opnieuw aangevraagd (max EXAM_TOPUP_ROUNDS rondes).
+    🧬 Ook (bijna) dubbele vragen tellen als tekort en worden bijgevraagd.
+    """
+    if duplicate_index is None:
+        duplicate_index = NearDuplicateIndex()
+    all_questions = []
+    missing = total_questions
     
-    # Clear progress indicators
-    progress_container.empty()
-    progress_bar.empty()
+    for round_index in range(EXAM_TOPUP_ROUNDS + 1):
+        # 🗄️ Zonder bronbestand is de prompt voor iedereen gelijk: de eerste ronde cachet per
+        # batch-positie, zodat batches binnen één tentamen niet dezelfde gecachete vragen krijgen.
+        # Aanvullingen worden nooit gecachet (anders komt hetzelfde kapotte antwoord terug).
+        use_cache = round_index == 0 and not source_text
+        all_questions.extend(generate_exam_batches(
+            client, study, subject, book, missing, source_text, question_type, job, session_id, use_cache, duplicate_index
+        ))
+        missing = total_questions - len(all_questions)
+        if missing <= 0 or round_index == EXAM_TOPUP_ROUNDS:
+            break
+        job.warn(f"🔁 {missing} ontbrekende vragen worden opnieuw aangevraagd.", "info")
     
     # Zorg dat we EXACT het juiste aantal vragen hebben
     if len(all_questions) > total_questions:
@@ -1507,8 +4315,36 @@ def generate_exam_questions(client: OpenAI, study: str, subject: str, book: str,
     return all_questions
 
 
+def run_exam_job(job: GenerationJob, client: OpenAI, study: str, subject: str, book: str, shortfall: int, source_context: str, question_type: str, prefetcher, prefetch_key: tuple, session_id: str, known_questions: list) -> list:
+    """
+    🧵 Generatie-job: eerst de prefetch-voorraad, dan het resterende tekort genereren.
+    🗄️ Zonder bestand is er geen voorraad: take() wacht dan alleen lopende prefetches af,
+    zodat de batches hieronder uit de response cache komen.
+    🧬 Vragen die (bijna) gelijk zijn aan de bankvragen van dit tentamen, aan eerdere tentamens
+    van deze sessie of aan elkaar vallen af.
+    📡 Het resultaat volgt de aankomstvolgorde van de job, zodat vragen die al in het
+    tentamen staan hun plek (en hun antwoord) houden.
+    """
+    duplicate_index = NearDuplicateIndex()
+    duplicate_index.filter(known_questions)
+    new_questions = duplicate_index.filter(prefetcher.take(prefetch_key, shortfall, job.cancel_token))
+    job.add_items(new_questions)
+    
+    remaining = shortfall - len(new_questions)
+    if remaining > 0:
+        generate_exam_questions(
+            client, study, subject, book, remaining, source_context, question_type, job, session_id, duplicate_index
+        )
+    return job.snapshot()["items"][:shortfall]
+
+
 def start_exam_mode(client: OpenAI, study: str, subject: str, book: str, num_questions: int, question_type: str = "Mix"):
-    """Start tentamenmodus - WERKT MET OF ZONDER BESTAND."""
+    """
+    Start tentamenmodus - WERKT MET OF ZONDER BESTAND.
+    🧵 Vragen uit de vragenbank zijn direct klaar; het tekort wordt als generatie-job
+    op de achtergrond gemaakt en afgerond door finish_exam_job.
+    📡 Het tentamen start meteen: nieuwe vragen verschijnen in het formulier zodra ze binnen zijn.
+    """
     
     # Check alleen of het een afbeelding is
     if st.session_state.file_type == "image":
@@ -1520,26 +4356,76 @@ def start_exam_mode(client: OpenAI, study: str, subject: str, book: str, num_que
         book_info = f" op basis van '{book}'" if book and book != "Geen specifiek boek / Algemeen" else ""
         st.info(f"💡 Geen bestand geüpload? Geen probleem. De AI genereert vragen{book_info} uit parate kennis over {subject}.")
     
-    # 🔧 FIX 1: Gebruik de nieuwe batching functie
-    questions = generate_exam_questions(
-        client, 
-        study, 
-        subject, 
-        book, 
-        num_questions, 
-        st.session_state.source_text if st.session_state.source_text else None,
-        question_type
+    # 🏦 Eerst ongeziene vragen uit de vragenbank, de AI genereert alleen het tekort
+    bank_filters = get_bank_filters(study, subject, book, question_type)
+    banked = take_from_bank("exam", bank_filters, num_questions)
+    shortfall = num_questions - len(banked)
+    
+    job_info = {"kind": "exam", "subject": subject, "bank_filters": bank_filters, "banked": banked}
+    st.session_state.exam_answers = {}
+    if shortfall <= 0:
+        finish_exam_job(job_info, [])
+        return
+    
+    # 🔎 Alleen de relevante delen van de bron gaan mee in de prompt
+    source_context = select_source_context(build_retrieval_query(subject, book)) if st.session_state.source_text else None
+    
+    # 🔮 De job neemt eerst de voorraad die op de achtergrond al klaargezet is
+    prefetch_key = get_prefetch_key("exam", study, subject, book, question_type)
+    submit_generation_job(
+        job_info, shortfall, run_exam_job,
+        client, study, subject, book, shortfall, source_context, question_type,
+        st.session_state.prefetcher, prefetch_key, current_session_id(),
+        st.session_state.exam_history + [item for _, item in banked]
     )
     
+    st.session_state.exam_questions = [item for _, item in banked]
+    st.session_state.exam_completed = False
+    st.session_state.context_set = True
+    st.rerun()
+
+
+def merge_exam_questions(job_info: dict, new_questions: list) -> tuple:
+    """
+    Bankvragen + nieuwe vragen in vaste volgorde: (alle vragen, unieke nieuwe vragen).
+    Geen dubbele vragen als de AI (of de response cache) een bankvraag herhaalt.
+    Een langere lijst new_questions levert altijd een verlenging van de vorige uitkomst op.
+    """
+    questions = [item for _, item in job_info["banked"]]
+    known_hashes = {QuestionBank.content_hash(item) for item in questions}
+    unique_new_questions = []
+    for item in new_questions:
+        item_hash = QuestionBank.content_hash(item)
+        if item_hash not in known_hashes:
+            known_hashes.add(item_hash)
+            unique_new_questions.append(item)
+    return questions + unique_new_questions, unique_new_questions
+
+
+def finish_exam_job(job_info: dict, new_questions: list):
+    """
+    Rond een tentamen-job af in de script thread: ontdubbelen, vragenbank bijwerken, tentamen starten.
+    Antwoorden die al tijdens het genereren gegeven zijn blijven staan.
+    Eindigt altijd met een volledige rerun, ook zonder vragen (terug naar het startscherm).
+    """
+    banked = job_info["banked"]
+    questions, new_questions = merge_exam_questions(job_info, new_questions)
+    
     if not questions or len(questions) == 0:
-        st.error("❌ Kon geen vragen genereren. Probeer opnieuw.")
-        return
+        st.session_state.exam_questions = []
+        st.session_state.context_set = False
+        notify("❌ Kon geen vragen genereren. Probeer opnieuw.", "error")
+        st.rerun()
+    
+    store_in_bank("exam", job_info["bank_filters"], banked, new_questions)
+    if banked:
+        notify(f"🏦 {len(banked)} vragen uit de vragenbank, {len(new_questions)} nieuw gegenereerd.")
     
     st.session_state.exam_questions = questions
-    st.session_state.exam_answers = {}
+    st.session_state.exam_history.extend(questions)
     st.session_state.exam_completed = False
     st.session_state.context_set = True
-    st.success(f"✅ Tentamen gegenereerd met {len(questions)} vragen over {subject}!")
+    notify(f"✅ Tentamen gegenereerd met {len(questions)} vragen over {job_info['subject']}!", "success")
     st.rerun()
 
 
@@ -1569,23 +4455,20 @@ def evaluate_exam():
 # 🃏 FLASHCARD MODUS FUNCTIES - FLEXIBEL (MET OF ZONDER BESTAND)
 # ============================================================================
 
-def generate_flashcards_json(client: OpenAI, study: str, subject: str, book: str, source_text: str = None):
-    """
-    🧠 INTELLIGENTE FLASHCARD GENERATIE
-    Werkt met OF zonder brontekst.
-    """
-    system_prompt = construct_system_prompt(study, subject, book, "flashcards")
-    messages = [{"role": "system", "content": system_prompt}]
+FLASHCARDS_PER_DECK = 10
+
+
+def build_flashcard_messages(study: str, subject: str, book: str, source_text: str = None) -> list:
+    """Bouw de berichten voor een flashcard deck (zonder AI aanroep); zelfde volgorde als de tentamen-batches."""
+    system_prompt = get_system_prompt(study, subject, book, "flashcards")
     
     if source_text and source_text.strip():
         # MET BRONTEKST
-        user_content = f"""STUDIEMATERIAAL voor {subject}:
-
-{source_text}
-
-INSTRUCTIE: Gebruik ENKEL de brontekst voor de flashcards.
+        messages = build_cacheable_messages(system_prompt, subject, source_text)
+        user_content = f"""INSTRUCTIE: Gebruik ENKEL de brontekst voor de flashcards.
 Genereer nu 10 flashcards SPECIFIEK over {subject} in JSON format."""
     else:
+        messages = [{"role": "system", "content": system_prompt.text}]
         # ZONDER BRONTEKST
         book_context = f" zoals behandeld in '{book}'" if book and book != "Geen specifiek boek / Algemeen" else ""
         user_content = f"""GEEN BRONTEKST BESCHIKBAAR.
@@ -1596,15 +4479,49 @@ Genereer de 10 belangrijkste begrippen/concepten die een student van {subject} M
 Genereer nu 10 flashcards SPECIFIEK over {subject} in JSON format."""
     
     messages.append({"role": "user", "content": user_content})
+    return messages
+
+
+def generate_flashcards_json(client: OpenAI, study: str, subject: str, book: str, source_text: str, job: GenerationJob, session_id: str = None):
+    """
+    🧠 INTELLIGENTE FLASHCARD GENERATIE
+    Werkt met OF zonder brontekst.
+    🧵 Draait binnen een generatie-job: geen Streamlit API's.
+    """
+    messages = build_flashcard_messages(study, subject, book, source_text)
     
-    with st.spinner(f"🃏 Flashcards worden gegenereerd voor {subject}..."):
-        response = get_ai_response(client, messages, has_image=False, json_mode=True)
+    # 🗄️ Zonder bronbestand is de prompt voor iedereen gelijk en dus cachebaar
+    cache_namespace = None if source_text and source_text.strip() else "flashcards"
+    response = get_ai_response(
+        client, messages, has_image=False, json_mode=True, cache_namespace=cache_namespace,
+        session_id=session_id, mode="flashcards", cancel_token=job.cancel_token
+    )
     
-    return clean_and_parse_json(response)
+    try:
+        records, rejected = parse_records(response, Flashcard)
+    except Exception as e:
+        job.warn(f"❌ Fout bij JSON parsing: {str(e)}", "error")
+        return None
+    if rejected:
+        job.warn(f"⚠️ {rejected} ongeldige flashcards overgeslagen.")
+    return [record.to_dict() for record in records]
+
+
+def run_flashcard_job(job: GenerationJob, client: OpenAI, study: str, subject: str, book: str, source_context: str, prefetcher, prefetch_key: tuple, session_id: str) -> list:
+    """🧵 Generatie-job: een klaargezet deck uit de prefetch-voorraad, anders een nieuw deck."""
+    flashcards = prefetcher.take(prefetch_key, job.total_items, job.cancel_token)
+    if not flashcards:
+        flashcards = generate_flashcards_json(client, study, subject, book, source_context, job, session_id) or []
+    job.add_items(flashcards)
+    return flashcards
 
 
 def start_flashcard_mode(client: OpenAI, study: str, subject: str, book: str):
-    """Start flashcard modus - WERKT MET OF ZONDER BESTAND."""
+    """
+    Start flashcard modus - WERKT MET OF ZONDER BESTAND.
+    🧵 Een deck uit de vragenbank is direct klaar; anders wordt het deck als
+    generatie-job op de achtergrond gemaakt en afgerond door finish_flashcard_job.
+    """
     
     # Check alleen of het een afbeelding is
     if st.session_state.file_type == "image":
@@ -1616,27 +4533,380 @@ def start_flashcard_mode(client: OpenAI, study: str, subject: str, book: str):
         book_info = f" uit '{book}'" if book and book != "Geen specifiek boek / Algemeen" else ""
         st.info(f"💡 Geen bestand geüpload? Geen probleem. De AI genereert flashcards{book_info} uit parate kennis over {subject}.")
     
-    # Genereer flashcards (met of zonder brontekst)
-    flashcards = generate_flashcards_json(
-        client,
-        study,
-        subject,
-        book,
-        st.session_state.source_text if st.session_state.source_text else None
+    # 🏦 Een volledig ongezien deck uit de vragenbank gaat voor,
+    # 🔮 dan een op de achtergrond klaargezet deck, anders een nieuw deck genereren
+    bank_filters = get_bank_filters(study, subject, book)
+    banked = take_from_bank("flashcard", bank_filters, FLASHCARDS_PER_DECK)
+    
+    if len(banked) >= FLASHCARDS_PER_DECK:
+        job_info = {"kind": "flashcards", "subject": subject, "bank_filters": bank_filters, "banked": banked}
+        finish_flashcard_job(job_info, [])
+        return
+    
+    # 🔎 Alleen de relevante delen van de bron gaan mee in de prompt
+    source_context = select_source_context(build_retrieval_query(subject, book)) if st.session_state.source_text else None
+    
+    job_info = {"kind": "flashcards", "subject": subject, "bank_filters": bank_filters, "banked": []}
+    prefetch_key = get_prefetch_key("flashcards", study, subject, book)
+    submit_generation_job(
+        job_info, FLASHCARDS_PER_DECK, run_flashcard_job,
+        client, study, subject, book, source_context,
+        st.session_state.prefetcher, prefetch_key, current_session_id()
     )
+
+
+def finish_flashcard_job(job_info: dict, new_flashcards: list):
+    """Rond een flashcard-job af in de script thread: vragenbank bijwerken en het deck starten."""
+    banked = job_info["banked"]
+    flashcards = [item for _, item in banked] if banked else new_flashcards
     
     if not flashcards or len(flashcards) == 0:
-        st.error("❌ Kon geen flashcards genereren. Probeer opnieuw.")
-        return
+        notify("❌ Kon geen flashcards genereren. Probeer opnieuw.", "error")
+        st.rerun()
+    
+    store_in_bank("flashcard", job_info["bank_filters"], banked, new_flashcards)
     
     st.session_state.flashcards = flashcards
     st.session_state.current_flashcard_index = 0
     st.session_state.show_flashcard_answer = False
     st.session_state.context_set = True
-    st.success(f"✅ {len(flashcards)} flashcards gegenereerd voor {subject}!")
+    notify(f"✅ {len(flashcards)} flashcards gegenereerd voor {job_info['subject']}!", "success")
+    st.rerun()
+
+
+# ============================================================================
+# 🧵 VOORTGANG VAN GENERATIE-JOBS
+# ============================================================================
+
+def notify(message: str, level: str = "info"):
+    """
+    Bewaar een melding voor de volgende volledige run. Een melding die een fragment vlak
+    vóór st.rerun() tekent, of die het volgende poll-moment overschrijft, zou direct verdwijnen.
+    """
+    st.session_state.notices.append((level, message))
+
+
+def render_notices():
+    """Toon de bewaarde meldingen buiten de fragmenten, één keer."""
+    for level, message in st.session_state.notices:
+        getattr(st, level)(message)
+    st.session_state.notices = []
+
+
+def submit_generation_job(job_info: dict, total_items: int, work, *args):
+    """Start een generatie-job voor deze sessie; een eerdere lopende job wordt afgebroken."""
+    previous = st.session_state.generation_job
+    if previous is not None:
+        previous["cancel_token"].cancel()
+    
+    cancel_token = st.session_state.generation_token.child()
+    job = get_job_registry().submit(job_info["kind"], total_items, cancel_token, work, *args)
+    st.session_state.generation_job = dict(job_info, job_id=job.job_id, cancel_token=cancel_token)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_generation_job():
+    """
+    Klein fragment dat de lopende generatie-job pollt: voortgang en de eerste
+    resultaten tonen, en de job afronden zodra hij klaar is. De rest van de
+    pagina wordt niet opnieuw uitgevoerd.
+    """
+    job_info = st.session_state.generation_job
+    if job_info is None:
+        return
+    
+    job = get_job_registry().get(job_info["job_id"])
+    if job is None:
+        st.session_state.generation_job = None
+        st.rerun()
+    
+    snapshot = job.snapshot()
+    label = "vragen" if job_info["kind"] == "exam" else "flashcards"
+    
+    if snapshot["status"] == "running":
+        received = min(len(snapshot["items"]), snapshot["total_items"])
+        st.info(f"⏳ {received}/{snapshot['total_items']} {label} klaar over {job_info['subject']}... ({snapshot['elapsed']:.0f}s)")
+        st.progress(received / max(snapshot["total_items"], 1))
+        
+        if snapshot["items"]:
+            with st.expander(f"👀 Eerste {label}"):
+                for item in snapshot["items"][:5]:
+                    st.caption(item.get("vraag") or item.get("term") or "")
+        
+        if st.button("⏹️ Annuleer", key="cancel_generation_job"):
+            job_info["cancel_token"].cancel()
+            st.session_state.generation_job = None
+            st.rerun()
+        return
+    
+    # Klaar: afronden in de script thread en de hele pagina opnieuw opbouwen
+    st.session_state.generation_job = None
+    for level, warning in snapshot["warnings"]:
+        notify(warning, level)
+    
+    if snapshot["status"] == "done":
+        if job_info["kind"] == "exam":
+            finish_exam_job(job_info, snapshot["result"] or [])
+        else:
+            finish_flashcard_job(job_info, snapshot["result"] or [])
+    elif snapshot["status"] == "failed":
+        notify(f"❌ Generatie mislukt: {snapshot['error']}", "error")
     st.rerun()
 
 
+# ============================================================================
+# 🧩 FRAGMENTEN (PARTIËLE RERUNS)
+# ============================================================================
+# Interacties binnen de chat, het tentamenformulier en de flashcard viewer voeren
+# alleen hun eigen fragment opnieuw uit, niet de sidebar, styling en header.
+
+def rerun_fragment():
+    """
+    Herlaad alleen het huidige fragment. Alleen aanroepen vanuit een fragment: tijdens
+    een volledige run (bv. direct na een modus-wissel) weigert Streamlit scope="fragment"
+    met een StreamlitAPIException, en dan volgt een gewone rerun.
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+@st.fragment
+def render_practice_chat(client: OpenAI):
+    """💬 Chatgedeelte van de oefenmodus, inclusief score."""
+    col_title, col_score = st.columns([3, 1])
+    with col_title:
+        st.subheader("💬 Training Sessie")
+    
+    # 📊 Score staat in het fragment (niet in de sidebar), zodat hij mee-ververst met elke beurt
+    if st.session_state.total_questions > 0:
+        with col_score:
+            score_display = f"{st.session_state.score} / {st.session_state.total_questions}"
+            percentage = (st.session_state.score / st.session_state.total_questions) * 100
+            st.metric("📊 Jouw Score", score_display)
+            st.progress(st.session_state.score / st.session_state.total_questions)
+            st.caption(f"✨ {percentage:.1f}% correct")
+    
+    for message in st.session_state.history:
+        if message["role"] == "assistant":
+            with st.chat_message("assistant", avatar="🤖"):
+                st.markdown(message["content"])
+        elif message["role"] == "user":
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(message["content"])
+    
+    # 🔧 BUG FIX 1: Trigger AI response als we vanuit tentamen komen
+    if st.session_state.trigger_ai_response:
+        st.session_state.trigger_ai_response = False
+        
+        # Haal de laatste user message op
+        if st.session_state.history and st.session_state.history[-1]["role"] == "user":
+            user_context_message = st.session_state.history[-1]["content"]
+            
+            # Trigger AI om direct te antwoorden
+            system_prompt = construct_system_prompt(
+                st.session_state.selected_major,
+                st.session_state.selected_subject,
+                st.session_state.selected_book,
+                "practice"
+            )
+            
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_context_message}
+            ]
+            
+            ai_response = stream_practice_reply(client, messages, has_image=False)
+            
+            if not ai_response.startswith("❌"):
+                st.session_state.history.append({
+                    "role": "assistant",
+                    "content": ai_response
+                })
+                rerun_fragment()
+    
+    # ⚡ Bereid de volgende vraag voor terwijl de student typt
+    if st.session_state.speculative_practice:
+        start_speculative_question(
+            client,
+            st.session_state.selected_major,
+            st.session_state.selected_subject,
+            st.session_state.selected_book
+        )
+    
+    user_input = st.chat_input("Type je antwoord hier...")
+    
+    if user_input:
+        handle_practice_answer(
+            client,
+            user_input,
+            st.session_state.selected_major,
+            st.session_state.selected_subject,
+            st.session_state.selected_book
+        )
+        rerun_fragment()
+
+
+def render_exam_form():
+    """
+    📝 Tentamenformulier als fragment. Zolang de tentamen-job nog vragen genereert,
+    pollt het fragment de job (run_every); daarna is het een gewoon fragment.
+    Het fragment-id hangt niet af van run_every, dus widgets en antwoorden blijven staan.
+    """
+    job_info = st.session_state.generation_job
+    streaming = job_info is not None and job_info["kind"] == "exam"
+    st.fragment(exam_form_fragment, run_every=JOB_POLL_SECONDS if streaming else None)()
+
+
+def poll_exam_job(job_info: dict) -> int:
+    """
+    Werk het tentamen bij met de vragen die de job tot nu toe heeft en geef het verwachte
+    aantal vragen terug. Is de job klaar, dan wordt hij afgerond met een volledige rerun;
+    meldingen gaan via notify, zodat de volgende poll ze niet wist.
+    """
+    job = get_job_registry().get(job_info["job_id"])
+    if job is None:
+        st.session_state.generation_job = None
+        st.rerun()
+    
+    snapshot = job.snapshot()
+    shortfall = snapshot["total_items"]
+    new_questions = snapshot["items"][:shortfall]
+    
+    if snapshot["status"] == "running":
+        st.session_state.exam_questions = merge_exam_questions(job_info, new_questions)[0]
+        expected = len(job_info["banked"]) + shortfall
+        received = len(st.session_state.exam_questions)
+        col_progress, col_cancel = st.columns([4, 1])
+        with col_progress:
+            st.caption(f"⏳ {received}/{expected} vragen klaar ({snapshot['elapsed']:.0f}s) · je kunt alvast beginnen")
+            st.progress(received / max(expected, 1))
+        with col_cancel:
+            if st.button("⏹️ Stop", key="stop_exam_generation", help="Stop met genereren en maak het tentamen met de vragen die er al zijn"):
+                job_info["cancel_token"].cancel()
+                st.session_state.generation_job = None
+                finish_exam_job(job_info, new_questions)
+        return expected
+    
+    # Klaar: afronden in de script thread en de hele pagina opnieuw opbouwen
+    # (finish_exam_job eindigt altijd met een volledige st.rerun())
+    st.session_state.generation_job = None
+    for level, warning in snapshot["warnings"]:
+        notify(warning, level)
+    if snapshot["status"] == "done":
+        finished_questions = snapshot["result"] or []
+    else:
+        if snapshot["status"] == "failed":
+            notify(f"❌ Generatie mislukt: {snapshot['error']}", "error")
+        finished_questions = new_questions
+    finish_exam_job(job_info, finished_questions)
+
+
+def exam_form_fragment():
+    """📝 Tentamenformulier; inleveren met openstaande vragen herlaadt alleen dit fragment."""
+    st.subheader("📝 Tentamen - Multiple Choice")
+    
+    job_info = st.session_state.generation_job
+    if job_info is not None and job_info["kind"] == "exam":
+        num_questions = poll_exam_job(job_info)
+    else:
+        num_questions = len(st.session_state.exam_questions)
+    st.info(f"📋 Tentamen met {num_questions} vragen over {st.session_state.selected_subject} | Beantwoord alle vragen en lever in")
+    
+    with st.form("exam_form"):
+        for i, question in enumerate(st.session_state.exam_questions):
+            st.markdown(f"### Vraag {i+1}")
+            st.markdown(question.get("vraag", ""))
+            
+            options = question.get("opties", [])
+            selected = st.radio(
+                f"Kies je antwoord:",
+                options,
+                key=f"q_{i}",
+                index=None
+            )
+            
+            if selected:
+                st.session_state.exam_answers[i] = selected
+            
+            st.markdown("---")
+        
+        submitted = st.form_submit_button("✅ Lever Tentamen In", use_container_width=True, type="primary")
+        
+        if submitted:
+            if len(st.session_state.exam_answers) < num_questions:
+                st.error(f"⚠️ Je hebt nog niet alle vragen beantwoord ({len(st.session_state.exam_answers)}/{num_questions})")
+            else:
+                st.session_state.exam_completed = True
+                st.rerun()  # De resultaten staan buiten het fragment
+
+
+@st.fragment
+def render_flashcard_viewer():
+    """🃏 Flashcard viewer; bladeren en omdraaien herlaadt alleen dit fragment."""
+    st.subheader("🃏 Flashcards")
+    
+    if st.session_state.flashcards:
+        total_cards = len(st.session_state.flashcards)
+        current_index = st.session_state.current_flashcard_index
+        current_card = st.session_state.flashcards[current_index]
+        
+        st.progress((current_index + 1) / total_cards)
+        st.caption(f"Kaart {current_index + 1} van {total_cards}")
+        
+        st.markdown("---")
+        
+        if not st.session_state.show_flashcard_answer:
+            st.markdown(f"### 📌 Begrip:")
+            st.markdown(f"## {current_card.get('term', '')}")
+            
+            st.markdown("---")
+            
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                if st.button("🔍 Toon Definitie", use_container_width=True, type="primary"):
+                    st.session_state.show_flashcard_answer = True
+                    rerun_fragment()
+        
+        else:
+            st.markdown(f"### 📌 Begrip:")
+            st.markdown(f"## {current_card.get('term', '')}")
+            
+            st.markdown("---")
+            
+            st.markdown(f"### ✅ Definitie:")
+            st.markdown(f"{current_card.get('definitie', '')}")
+            
+            st.markdown("---")
+            
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                if current_index > 0:
+                    if st.button("⬅️ Vorige", use_container_width=True):
+                        st.session_state.current_flashcard_index -= 1
+                        st.session_state.show_flashcard_answer = False
+                        rerun_fragment()
+            
+            with col2:
+                if st.button("🔄 Verberg", use_container_width=True):
+                    st.session_state.show_flashcard_answer = False
+                    rerun_fragment()
+            
+            with col3:
+                if current_index < total_cards - 1:
+                    if st.button("Volgende ➡️", use_container_width=True, type="primary"):
+                        st.session_state.current_flashcard_index += 1
+                        st.session_state.show_flashcard_answer = False
+                        rerun_fragment()
+                else:
+                    st.success("🎉 Alle kaarten voltooid!")
+    
+    else:
+        st.info("Geen flashcards beschikbaar.")
+
+
 # ============================================================================
 # 🚀 MAIN APPLICATIE
 # ============================================================================
@@ -1719,7 +4989,8 @@ def main():
             "Specifiek vak:",
             current_subjects,
             index=current_subject_index,
-            key="subject_selector"
+            key="subject_selector",
+            on_change=cancel_generation  # 🛑 Lopende generatie hoort bij het oude vak
         )
         st.session_state.selected_subject = selected_subject
         
@@ -1756,6 +5027,14 @@ def main():
         )
         st.session_state.study_mode = study_mode
         
+        # ⚡ Speculatief oefenen (opt-in: kost extra tokens per beurt)
+        if study_mode == "🟢 Oefenen":
+            st.toggle(
+                "⚡ Speculatief oefenen",
+                key="speculative_practice",
+                help="Bereidt de volgende vraag al voor terwijl je typt, zodat de AI sneller reageert (kost extra tokens)"
+            )
+        
         # Slider voor Tentamen
         if study_mode == "📝 Tentamen Simulatie":
             st.markdown("#### ⚙️ Tentamen Instellingen")
@@ -1783,19 +5062,6 @@ def main():
         
         st.markdown("---")
         
-        # Score weergave
-        if st.session_state.study_mode == "🟢 Oefenen" and st.session_state.context_set and st.session_state.total_questions > 0:
-            st.markdown("### 📊 Jouw Score")
-            
-            score_display = f"{st.session_state.score} / {st.session_state.total_questions}"
-            percentage = (st.session_state.score / st.session_state.total_questions) * 100
-            
-            st.metric("Score", score_display)
-            st.progress(st.session_state.score / st.session_state.total_questions)
-            st.caption(f"✨ {percentage:.1f}% correct")
-            
-            st.markdown("---")
-        
         # Reset knop
         if st.button("🔄 Reset Sessie", use_container_width=True):
             reset_session()
@@ -1837,6 +5103,8 @@ def main():
         if selected_book != "Geen specifiek boek / Algemeen":
             st.caption(f"📚 {selected_book}")
         st.caption(f"🎯 {study_mode}")
+        
+        render_performance_stats()
     
     # ========================================================================
     # ✅ BEPAAL CURRENT_CONFIG NA SIDEBAR RENDERING
@@ -1861,6 +5129,9 @@ def main():
     st.markdown(f"**Modus:** {st.session_state.study_mode}")
     st.markdown("---")
     
+    # 📣 Meldingen van afgeronde jobs (buiten de fragmenten, dus niet weg bij de volgende poll)
+    render_notices()
+    
     # ========================================================================
     # UPLOAD INTERFACE
     # ========================================================================
@@ -1879,11 +5150,24 @@ def main():
             
             if file_extension == "pdf":
                 with st.spinner("📄 PDF wordt verwerkt..."):
-                    text, num_pages = extract_text_from_pdf(uploaded_file)
+                    pdf_result = extract_text_from_pdf(uploaded_file)
+                    text = pdf_result["text"]
                     if text:
                         st.session_state.source_text = text
+                        st.session_state.source_hash = pdf_result["source_hash"]
                         st.session_state.file_type = "pdf"
-                        st.success(f"✅ PDF succesvol verwerkt! ({num_pages} pagina's, {len(text)} karakters)")
+                        
+                        # 🔎 Bouw de retrieval index direct bij upload (gecachet per hash)
+                        if len(text) > RETRIEVAL_MIN_SOURCE_CHARS:
+                            get_source_index(pdf_result["source_hash"], text)
+                        
+                        num_pages = pdf_result["num_pages"]
+                        elapsed = pdf_result["elapsed"]
+                        pages_per_sec = num_pages / elapsed if elapsed > 0 else 0
+                        st.success(
+                            f"✅ PDF succesvol verwerkt! ({num_pages} pagina's, {len(text)} karakters) "
+                            f"in {elapsed:.2f}s – {pages_per_sec:.0f} pagina's/s via {pdf_result['method']}"
+                        )
             
             elif file_extension in ["png", "jpg", "jpeg"]:
                 if st.session_state.study_mode != "🟢 Oefenen":
@@ -1896,6 +5180,14 @@ def main():
                         st.image(uploaded_file, caption="Geüploade afbeelding", use_container_width=True)
                         st.success("✅ Afbeelding succesvol verwerkt!")
         
+        # 🔮 Zet op de achtergrond alvast een tentamen/flashcard deck klaar
+        prefetch_generation(
+            client,
+            st.session_state.selected_major,
+            st.session_state.selected_subject,
+            st.session_state.selected_book
+        )
+        
         # Start knoppen (dynamisch per modus)
         st.markdown("---")
         
@@ -1969,6 +5261,10 @@ def main():
                         st.session_state.selected_subject,
                         st.session_state.selected_book
                     )
+        
+        # 🧵 Voortgang van een lopende generatie-job (tentamen of flashcards)
+        if st.session_state.generation_job is not None:
+            render_generation_job()
     
     # ========================================================================
     # ACTIEVE SESSIE
@@ -1976,92 +5272,11 @@ def main():
     
     else:
         if st.session_state.study_mode == "🟢 Oefenen":
-            st.subheader("💬 Training Sessie")
-            
-            # 🔧 BUG FIX 1: Trigger AI response als we vanuit tentamen komen
-            if st.session_state.trigger_ai_response:
-                st.session_state.trigger_ai_response = False
-                
-                # Haal de laatste user message op
-                if st.session_state.history and st.session_state.history[-1]["role"] == "user":
-                    user_context_message = st.session_state.history[-1]["content"]
-                    
-                    # Trigger AI om direct te antwoorden
-                    system_prompt = construct_system_prompt(
-                        st.session_state.selected_major,
-                        st.session_state.selected_subject,
-                        st.session_state.selected_book,
-                        "practice"
-                    )
-                    
-                    messages = [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_context_message}
-                    ]
-                    
-                    with st.spinner("🤖 AI bereidt een uitgebreide uitleg voor..."):
-                        ai_response = get_ai_response(client, messages, has_image=False)
-                    
-                    if not ai_response.startswith("❌"):
-                        st.session_state.history.append({
-                            "role": "assistant",
-                            "content": ai_response
-                        })
-                        st.rerun()
-            
-            for message in st.session_state.history:
-                if message["role"] == "assistant":
-                    with st.chat_message("assistant", avatar="🤖"):
-                        st.markdown(message["content"])
-                elif message["role"] == "user":
-                    with st.chat_message("user", avatar="👤"):
-                        st.markdown(message["content"])
-            
-            user_input = st.chat_input("Type je antwoord hier...")
-            
-            if user_input:
-                handle_practice_answer(
-                    client,
-                    user_input,
-                    st.session_state.selected_major,
-                    st.session_state.selected_subject,
-                    st.session_state.selected_book
-                )
-                st.rerun()
+            render_practice_chat(client)
         
         elif st.session_state.study_mode == "📝 Tentamen Simulatie":
             if not st.session_state.exam_completed:
-                st.subheader("📝 Tentamen - Multiple Choice")
-                
-                num_questions = len(st.session_state.exam_questions)
-                st.info(f"📋 Tentamen met {num_questions} vragen over {st.session_state.selected_subject} | Beantwoord alle vragen en lever in")
-                
-                with st.form("exam_form"):
-                    for i, question in enumerate(st.session_state.exam_questions):
-                        st.markdown(f"### Vraag {i+1}")
-                        st.markdown(question.get("vraag", ""))
-                        
-                        options = question.get("opties", [])
-                        selected = st.radio(
-                            f"Kies je antwoord:",
-                            options,
-                            key=f"q_{i}",
-                            index=None
-                        )
-                        
-                        if selected:
-                            st.session_state.exam_answers[i] = selected
-                        
-                        st.markdown("---")
-                    
-                    submitted = st.form_submit_button("✅ Lever Tentamen In", use_container_width=True, type="primary")
-                    
-                    if submitted:
-                        if len(st.session_state.exam_answers) < num_questions:
-                            st.error(f"⚠️ Je hebt nog niet alle vragen beantwoord ({len(st.session_state.exam_answers)}/{num_questions})")
-                        else:
-                            st.session_state.exam_completed = True
-                            st.rerun()
+                render_exam_form()
             
             else:
                 st.subheader("📊 Tentamen Resultaten")
@@ -2130,66 +5345,7 @@ def main():
                                 )
         
         else:  # Flashcards
-            st.subheader("🃏 Flashcards")
-            
-            if st.session_state.flashcards:
-                total_cards = len(st.session_state.flashcards)
-                current_index = st.session_state.current_flashcard_index
-                current_card = st.session_state.flashcards[current_index]
-                
-                st.progress((current_index + 1) / total_cards)
-                st.caption(f"Kaart {current_index + 1} van {total_cards}")
-                
-                st.markdown("---")
-                
-                if not st.session_state.show_flashcard_answer:
-                    st.markdown(f"### 📌 Begrip:")
-                    st.markdown(f"## {current_card.get('term', '')}")
-                    
-                    st.markdown("---")
-                    
-                    col1, col2, col3 = st.columns([1, 2, 1])
-                    with col2:
-                        if st.button("🔍 Toon Definitie", use_container_width=True, type="primary"):
-                            st.session_state.show_flashcard_answer = True
-                            st.rerun()
-                
-                else:
-                    st.markdown(f"### 📌 Begrip:")
-                    st.markdown(f"## {current_card.get('term', '')}")
-                    
-                    st.markdown("---")
-                    
-                    st.markdown(f"### ✅ Definitie:")
-                    st.markdown(f"{current_card.get('definitie', '')}")
-                    
-                    st.markdown("---")
-                    
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        if current_index > 0:
-                            if st.button("⬅️ Vorige", use_container_width=True):
-                                st.session_state.current_flashcard_index -= 1
-                                st.session_state.show_flashcard_answer = False
-                                st.rerun()
-                    
-                    with col2:
-                        if st.button("🔄 Verberg", use_container_width=True):
-                            st.session_state.show_flashcard_answer = False
-                            st.rerun()
-                    
-                    with col3:
-                        if current_index < total_cards - 1:
-                            if st.button("Volgende ➡️", use_container_width=True, type="primary"):
-                                st.session_state.current_flashcard_index += 1
-                                st.session_state.show_flashcard_answer = False
-                                st.rerun()
-                        else:
-                            st.success("🎉 Alle kaarten voltooid!")
-            
-            else:
-                st.info("Geen flashcards beschikbaar.")
+            render_flashcard_viewer()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+"""
+Benchmark: parsen van tentamen-batches, strikt schema tegenover de tolerante parser.
+
+Vergelijkt per batchgrootte:
+- schema: parse_records op een response die aan het strikte schema voldoet (één json.loads)
+- tolerant: parse_json_items (code fences, sleutels zoeken) + validatie per vraag, zoals vóór structured outputs
+- gered: parse_records op een afgekapte response met LaTeX escapes (herstel + redden)
+
+Gebruik (vanuit de root van de repository):
+    python benchmarks/bench_structured_parse.py [aantal_herhalingen]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import Full_studie_trainer_app as app
+
+
+def time_per_call(func, repeats: int) -> float:
+    """Gemiddelde tijd per aanroep in microseconden."""
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - started) / repeats * 1e6
+
+
+def make_questions(count: int) -> list:
+    return [
+        {
+            "vraag": f"Vraag {index}: welke structuur wordt beschreven door $x^2$ in dit voorbeeld?",
+            "opties": [f"A) Optie {index}a", f"B) Optie {index}b", f"C) Optie {index}c", f"D) Optie {index}d"],
+            "correct_antwoord": f"B) Optie {index}b",
+            "uitleg": "Omdat de beschrijving in de brontekst precies overeenkomt met optie B. " * 3
+        }
+        for index in range(count)
+    ]
+
+
+def tolerant_parse(response: str) -> list:
+    items = app.parse_json_items(response)
+    return [record for record in map(app.ExamQuestion.from_dict, items) if record is not None]
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    
+    print(f"{'vragen':>6} {'schema':>11} {'tolerant':>11} {'gered':>11}")
+    for count in (5, 20, 100, 500):
+        strict_response = json.dumps({"questions": make_questions(count)}, ensure_ascii=False)
+        fenced_response = f"```json\n{strict_response}\n```"
+        broken_response = strict_response.replace("$x^2$", "$\\sqrt{x}$")[:-len(strict_response) // (2 * count)]
+        
+        assert len(app.parse_records(strict_response, app.ExamQuestion)[0]) == count
+        assert len(tolerant_parse(fenced_response)) == count
+        salvaged = len(app.parse_records(broken_response, app.ExamQuestion)[0])
+        
+        strict_time = time_per_call(lambda: app.parse_records(strict_response, app.ExamQuestion), repeats)
+        tolerant_time = time_per_call(lambda: tolerant_parse(fenced_response), repeats)
+        salvage_time = time_per_call(lambda: app.parse_records(broken_response, app.ExamQuestion), repeats)
+        
+        print(f"{count:>6} {strict_time:>9.0f}µs {tolerant_time:>9.0f}µs {salvage_time:>9.0f}µs"
+              f"  ({salvaged}/{count} gered)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark: thema-CSS per rerun, voor en na het cachen + minificeren.
+
+Vergelijkt per studiekleur:
+- payload: grootte van het Markdown element dat elke rerun naar de browser gaat
+- bouwtijd: f-string opbouwen (oud) tegenover een dict lookup (nieuw)
+- serialisatietijd van het element
+
+Gebruik (vanuit de root van de repository):
+    python benchmarks/bench_theme_css.py [aantal_reruns]
+"""
+
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+from streamlit.proto.Markdown_pb2 import Markdown
+
+import Full_studie_trainer_app as app
+
+
+def time_per_call(func, repeats: int) -> float:
+    """Gemiddelde tijd per aanroep in microseconden."""
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - started) / repeats * 1e6
+
+
+def markdown_element(css: str) -> Markdown:
+    return Markdown(body=css, allow_html=True)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    colors = sorted({config["color"] for config in app.STUDY_FIELDS.values()})
+    
+    print(f"{'kleur':<9} {'payload oud':>12} {'payload nieuw':>14} {'besparing':>10} "
+          f"{'bouw oud':>10} {'bouw nieuw':>11} {'serialisatie oud':>17} {'serialisatie nieuw':>19}")
+    
+    for color in colors:
+        old_css = app.build_theme_css(color)
+        new_css = app.get_theme_css(color)
+        old_element = markdown_element(old_css)
+        new_element = markdown_element(new_css)
+        
+        old_bytes = old_element.ByteSize()
+        new_bytes = new_element.ByteSize()
+        build_old = time_per_call(lambda: markdown_element(app.build_theme_css(color)), repeats)
+        build_new = time_per_call(lambda: markdown_element(app.get_theme_css(color)), repeats)
+        serialize_old = time_per_call(old_element.SerializeToString, repeats)
+        serialize_new = time_per_call(new_element.SerializeToString, repeats)
+        
+        print(f"{color:<9} {old_bytes:>10} B {new_bytes:>12} B {1 - new_bytes / old_bytes:>9.0%} "
+              f"{build_old:>8.1f}µs {build_new:>9.1f}µs {serialize_old:>15.1f}µs {serialize_new:>17.1f}µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""
+PDF extractie worker voor de White Label Studie-Applicatie.
+
+Deze functie staat in een aparte module zodat worker processen van de
+ProcessPoolExecutor hem kunnen importeren: Streamlit voert het hoofdscript
+uit als __main__, waardoor functies daarin niet picklebaar zijn.
+"""
+
+import io
+from PyPDF2 import PdfReader
+
+
+def extract_page_range(pdf_bytes: bytes, start: int, end: int) -> list:
+    """Extraheer de tekst van pagina's [start, end) en geef één string per pagina terug."""
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [pdf_reader.pages[index].extract_text() for index in range(start, end)]